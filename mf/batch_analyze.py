@@ -0,0 +1,285 @@
+"""
+离线批量情绪分析 - 对录制的视频文件或图片目录执行与实时服务相同的检测流程
+
+用法示例:
+    python batch_analyze.py recording.mp4 --output results.csv --workers 8
+    python batch_analyze.py frames_dir/ --output results.parquet --outputs emotion,aus
+    python batch_analyze.py recording.mp4 --sample-fps 5 --report-dir reports/
+
+输入按帧序号切分为若干段，由多个进程并行解码和推理(每个进程有自己的Detector)，
+每段内的帧按批次交给 run_detection_batch；各段结果按顺序写入CSV/Parquet，
+并累计到 EmotionAnalyzer 生成与实时服务相同格式的PDF报告。
+画面中的每张人脸各占一行：face 为该帧内的人脸序号，person 为按人脸框IoU在相邻采样帧之间匹配得到的人员编号
+(与实时服务相同的 FaceIdentities)，总体统计使用每帧的第一张人脸，报告中另有每个人的统计。
+"""
+
+import argparse
+import csv
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+import python_server
+from python_server import (
+    AU_COLUMNS, EMOTION_COLUMNS, EmotionAnalyzer, FaceIdentities, FileReportSink,
+    resolve_pipeline_stages, run_detection_batch
+)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+# 每段的帧数：段越小各进程负载越均衡，但视频每段都要重新打开并定位
+SEGMENT_FRAMES = 1000
+
+RESULT_COLUMNS = (
+    ['frame', 'time', 'face', 'person', 'face_x1', 'face_y1', 'face_x2', 'face_y2', 'face_score']
+    + EMOTION_COLUMNS + ['emotion'] + AU_COLUMNS
+)
+# 各部分在结果行中的起始位置
+BOX_START = 4
+EMOTION_START = BOX_START + 5
+AU_START = EMOTION_START + len(EMOTION_COLUMNS) + 1
+
+def list_images(directory):
+    """目录中的图片文件，按文件名排序"""
+    names = sorted(name for name in os.listdir(directory) if name.lower().endswith(IMAGE_EXTENSIONS))
+    return [os.path.join(directory, name) for name in names]
+
+def video_info(path):
+    """返回视频的总帧数和帧率"""
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError(f"无法打开视频文件: {path}")
+    total = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+    capture.release()
+    return total, fps
+
+def plan_segments(total, stride):
+    """把 [0, total) 的帧按 SEGMENT_FRAMES 切分，段起点对齐到采样步长"""
+    step = max(SEGMENT_FRAMES // stride, 1) * stride
+    return [(start, min(start + step, total)) for start in range(0, total, step)]
+
+def _resize(img, max_size):
+    """长边超过 max_size 时缩小，返回图像和缩放比例"""
+    height, width = img.shape[:2]
+    scale = max_size / max(height, width) if max_size else 1.0
+    if scale >= 1.0:
+        return img, 1.0
+    return cv2.resize(img, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA), scale
+
+def _read_video_segment(path, start, end, stride):
+    capture = cv2.VideoCapture(path)
+    capture.set(cv2.CAP_PROP_POS_FRAMES, start)
+    try:
+        for index in range(start, end):
+            # 不需要的帧只 grab 不解码
+            if (index - start) % stride:
+                if not capture.grab():
+                    break
+                continue
+            ok, frame = capture.read()
+            if not ok:
+                break
+            yield index, frame
+    finally:
+        capture.release()
+
+def _read_image_segment(paths, start, end, stride):
+    for index in range(start, end, stride):
+        frame = cv2.imread(paths[index])
+        if frame is not None:
+            yield index, frame
+
+def _result_rows(index, timestamp, result, scale):
+    """一帧的结果行：每张人脸一行，未检测到面部时只有帧号和时间；人员编号由主进程按顺序分配"""
+    empty = [index, round(timestamp, 3)] + [''] * (len(RESULT_COLUMNS) - 2)
+    if result is None:
+        return [empty]
+    rows = []
+    for face_index, face in enumerate(result['faces']):
+        row = list(empty)
+        row[2] = face_index
+        row[BOX_START:BOX_START + 4] = [round(float(v) / scale, 1) for v in face[:4]]
+        row[BOX_START + 4] = round(float(face[4]), 4)
+        if result['emotions'] is not None and face_index < len(result['emotions']):
+            probs = np.asarray(result['emotions'][face_index], dtype=float).reshape(-1)
+            row[EMOTION_START:AU_START - 1] = [round(float(v), 4) for v in probs]
+            row[AU_START - 1] = EMOTION_COLUMNS[int(np.argmax(probs))]
+        if result['aus'] is not None and face_index < len(result['aus']):
+            row[AU_START:] = [round(float(v), 4) for v in np.asarray(result['aus'][face_index]).reshape(-1)]
+        rows.append(row)
+    return rows
+
+def analyze_segment(source, start, end, options):
+    """工作进程中执行：解码一段帧并按批次推理，返回该段每个采样帧的结果行"""
+    python_server.TORCH_THREADS = options['torch_threads']
+    stages = resolve_pipeline_stages(options['outputs'])
+    if isinstance(source, list):
+        frames = _read_image_segment(source, start, end, options['stride'])
+    else:
+        frames = _read_video_segment(source, start, end, options['stride'])
+
+    rows = []
+    batch, indices, scales = [], [], []
+
+    def flush():
+        results = run_detection_batch(batch, stage_sets=[stages] * len(batch))
+        for index, scale, result in zip(indices, scales, results):
+            rows.extend(_result_rows(index, index / options['fps'], result, scale))
+        batch.clear()
+        indices.clear()
+        scales.clear()
+
+    for index, frame in frames:
+        img, scale = _resize(frame, options['max_size'])
+        batch.append(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+        indices.append(index)
+        scales.append(scale)
+        if len(batch) >= options['batch_size']:
+            flush()
+    if batch:
+        flush()
+    return rows
+
+class CsvResultWriter:
+    def __init__(self, path):
+        self.file = open(path, 'w', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(RESULT_COLUMNS)
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+class ParquetResultWriter:
+    """按段追加写入Parquet，需要安装pyarrow"""
+
+    def __init__(self, path):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.pa = pa
+        fields = [pa.field('frame', pa.int64()), pa.field('time', pa.float64()),
+                  pa.field('face', pa.int64()), pa.field('person', pa.int64())]
+        fields += [pa.field(name, pa.float64()) for name in RESULT_COLUMNS[BOX_START:EMOTION_START] + EMOTION_COLUMNS]
+        fields += [pa.field('emotion', pa.string())]
+        fields += [pa.field(name, pa.float64()) for name in AU_COLUMNS]
+        self.schema = pa.schema(fields)
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+    def write(self, rows):
+        if not rows:
+            return
+        columns = list(zip(*rows))
+        arrays = []
+        for field, values in zip(self.schema, columns):
+            values = [None if value == '' else value for value in values]
+            arrays.append(self.pa.array(values, type=field.type))
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+def open_result_writer(path):
+    if path.lower().endswith('.parquet'):
+        try:
+            return ParquetResultWriter(path)
+        except ImportError:
+            path = os.path.splitext(path)[0] + '.csv'
+            logging.warning(f"未安装pyarrow，结果改为写入CSV: {path}")
+    return CsvResultWriter(path)
+
+def assign_people(identities, rows):
+    """按帧的顺序为每张人脸分配人员编号；结果行需按帧号排列，未检测到面部的帧也参与计数"""
+    start = 0
+    while start < len(rows):
+        end = start
+        while end < len(rows) and rows[end][0] == rows[start][0]:
+            end += 1
+        faces = [row for row in rows[start:end] if row[2] != '']
+        for row, person in zip(faces, identities.assign([row[BOX_START:BOX_START + 4] for row in faces])):
+            row[3] = person
+        start = end
+
+def accumulate(analyzer, rows):
+    """把结果行累计到情绪分析器，供生成PDF报告：总体统计使用每帧的第一张人脸，同时累计每个人的统计"""
+    for row in rows:
+        emotion = row[AU_START - 1]
+        if emotion:
+            if row[2] == 0:
+                analyzer.update_stats(emotion, row[EMOTION_START:AU_START - 1], row[1])
+            analyzer.update_person(row[3], emotion, row[1])
+        if row[2] == 0 and row[AU_START] != '':
+            analyzer.update_aus(row[AU_START:])
+
+def main():
+    parser = argparse.ArgumentParser(description="离线批量情绪分析：视频文件或图片目录")
+    parser.add_argument('input', help="视频文件或图片目录")
+    parser.add_argument('--output', default='emotion_results.csv', help="逐帧结果文件(.csv 或 .parquet)")
+    parser.add_argument('--report-dir', default=python_server.REPORT_DIR, help="PDF报告输出目录")
+    parser.add_argument('--outputs', default='emotion', help="输出项，逗号分隔: emotion,aus,landmarks")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="并行进程数")
+    parser.add_argument('--batch-size', type=int, default=python_server.BATCH_MAX_SIZE, help="每批推理的帧数")
+    parser.add_argument('--sample-fps', type=float, default=0, help="视频每秒采样帧数，0表示逐帧分析")
+    parser.add_argument('--max-size', type=int, default=640, help="图像长边超过该值时先缩小再检测，0表示不缩小")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    if os.path.isdir(args.input):
+        source = list_images(args.input)
+        total, fps = len(source), 1.0
+    else:
+        source = args.input
+        total, fps = video_info(args.input)
+    stride = max(1, int(round(fps / args.sample_fps))) if args.sample_fps else 1
+
+    workers = max(1, args.workers)
+    options = {
+        'outputs': args.outputs.split(','),
+        'stride': stride,
+        'fps': fps,
+        'batch_size': args.batch_size,
+        'max_size': args.max_size,
+        'torch_threads': python_server.TORCH_THREADS or max(1, (os.cpu_count() or 1) // workers)
+    }
+    resolve_pipeline_stages(options['outputs'])
+    segments = plan_segments(total, stride)
+    logging.info(f"开始分析 {args.input}: {total} 帧, 帧率 {fps:.2f}, 采样步长 {stride}, "
+                 f"{len(segments)} 段, {workers} 个进程")
+
+    analyzer = EmotionAnalyzer()
+    identities = FaceIdentities()
+    writer = open_result_writer(args.output)
+    processed = 0
+    try:
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            futures = [pool.submit(analyze_segment, source, start, end, options) for start, end in segments]
+            # 按段的顺序取结果，保证输出文件按帧序号排列
+            for done, future in enumerate(futures, 1):
+                rows = future.result()
+                assign_people(identities, rows)
+                writer.write(rows)
+                accumulate(analyzer, rows)
+                processed += len({row[0] for row in rows})
+                elapsed = time.perf_counter() - started
+                logging.info(f"已完成 {done}/{len(segments)} 段, {processed} 帧, {processed / elapsed:.1f} 帧/秒")
+    finally:
+        writer.close()
+
+    elapsed = time.perf_counter() - started
+    media_seconds = total / fps if not isinstance(source, list) else 0
+    logging.info(f"分析完成: {processed} 帧, 用时 {elapsed:.1f} 秒"
+                 + (f", 为实时速度的 {media_seconds / elapsed:.1f} 倍" if media_seconds else ""))
+
+    os.makedirs(args.report_dir, exist_ok=True)
+    session_id = os.path.splitext(os.path.basename(os.path.normpath(args.input)))[0]
+    analyzer.generate_pdf_report(FileReportSink(args.report_dir), session_id)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+"""
+服务端吞吐和延迟基准测试
+
+用法示例:
+    # 用桩检测器(固定各阶段耗时)只测服务层，不需要模型权重
+    python benchmark.py --mode stub --clients 8 --fps 15 --duration 30 --json bench_stub.json
+    # 使用真实模型
+    python benchmark.py --mode real --clients 4 --fps 10 --image images/1.jpeg
+    # 压测已经在运行的服务
+    python benchmark.py --url ws://localhost:8765 --clients 16 --fps 20
+
+每个客户端按目标帧率发送带帧头的二进制JPEG帧，根据回复中的客户端帧号(frame:序号:客户端帧号 或 result:{...})计算端到端延迟；
+发出但始终没有收到回复的帧(被信箱丢弃)计入丢帧率。结果输出到终端并可保存为JSON，便于比较回归。
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+
+import cv2
+import numpy as np
+import websockets
+
+import python_server
+from python_server import AU_COLUMNS, EMOTION_COLUMNS, FRAME_HEADER, FRAME_MAGIC
+
+# 桩检测器各阶段的默认耗时(毫秒)：每次调用的固定开销和每帧的耗时
+STUB_CALL_MS = {'faces': 4.0, 'landmarks': 1.0, 'aus': 1.0, 'emotions': 2.0}
+STUB_FRAME_MS = {'faces': 6.0, 'landmarks': 2.0, 'aus': 2.0, 'emotions': 4.0}
+
+class StubDetector:
+    """与 feat.Detector 接口相同的桩检测器，按配置的耗时休眠后返回固定形状的结果"""
+
+    def __init__(self, call_ms=None, frame_ms=None):
+        self.call_ms = dict(STUB_CALL_MS, **(call_ms or {}))
+        self.frame_ms = dict(STUB_FRAME_MS, **(frame_ms or {}))
+
+    def _wait(self, stage, frames):
+        time.sleep((self.call_ms[stage] + self.frame_ms[stage] * frames) / 1000)
+
+    def detect_faces(self, frame, **kwargs):
+        self._wait('faces', len(frame))
+        results = []
+        for image in frame:
+            height, width = image.shape[:2]
+            results.append([[width * 0.25, height * 0.2, width * 0.75, height * 0.8, 0.99]])
+        return results
+
+    def detect_landmarks(self, frame, detected_faces, **kwargs):
+        self._wait('landmarks', len(frame))
+        return [[np.zeros((68, 2)) for _ in frame_faces] for frame_faces in detected_faces]
+
+    def detect_aus(self, frame, landmarks, **kwargs):
+        self._wait('aus', len(frame))
+        return [np.full((len(frame_landmarks), len(AU_COLUMNS)), 0.5) for frame_landmarks in landmarks]
+
+    def detect_emotions(self, frame, facebox, landmarks, **kwargs):
+        self._wait('emotions', len(frame))
+        probs = np.full(len(EMOTION_COLUMNS), 0.05)
+        probs[EMOTION_COLUMNS.index('neutral')] = 0.7
+        return [np.tile(probs, (len(frame_faces), 1)) for frame_faces in facebox]
+
+def parse_stage_ms(text):
+    """解析 faces=8,emotions=4 形式的阶段耗时"""
+    if not text:
+        return {}
+    return {stage: float(ms) for stage, ms in (item.split('=') for item in text.split(','))}
+
+def synthetic_jpeg(path=None, size=(320, 240), quality=80):
+    """读取指定图片或生成随机图像，编码为JPEG字节"""
+    img = cv2.imread(path) if path else None
+    if img is None:
+        width, height = size
+        img = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+        img = cv2.GaussianBlur(img, (9, 9), 0)
+    ok, data = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return data.tobytes()
+
+class ClientStats:
+    def __init__(self):
+        self.sent = 0
+        self.answered = 0
+        self.busy = 0
+        self.errors = 0
+        self.latencies = []
+
+async def run_client(url, jpeg, fps, duration, grace, stats, protocol='legacy', coalesce=False):
+    """一个模拟客户端：按目标帧率发送帧，同时接收回复统计延迟"""
+    send_times = {}
+    interval = 1.0 / fps
+    async with websockets.connect(url, max_size=None) as websocket:
+        if protocol != 'legacy':
+            await websocket.send('config:' + json.dumps({'protocol': protocol, 'coalesce': coalesce}))
+
+        def answered(frame_id):
+            if frame_id in send_times:
+                stats.latencies.append((time.perf_counter() - send_times.pop(frame_id)) * 1000)
+                stats.answered += 1
+
+        async def receive():
+            async for message in websocket:
+                if isinstance(message, bytes):
+                    continue
+                if message.startswith('frame:'):
+                    parts = message.split(':')
+                    if len(parts) == 3:
+                        answered(int(parts[2]))
+                elif message.startswith('result:') or message.startswith('results:'):
+                    prefix, _, body = message.partition(':')
+                    results = json.loads(body)
+                    for result in (results if prefix == 'results' else [results]):
+                        if result['status'] == 'busy':
+                            stats.busy += 1
+                        elif result['status'] in ('failed', 'decode_failed'):
+                            stats.errors += 1
+                        else:
+                            answered(result.get('id'))
+                elif message.startswith('busy:'):
+                    stats.busy += 1
+                elif message in ('情绪识别失败', '图像转换失败') or message.startswith('处理'):
+                    stats.errors += 1
+
+        receiver = asyncio.create_task(receive())
+        started = time.perf_counter()
+        frame_id = 0
+        while time.perf_counter() - started < duration:
+            header = FRAME_HEADER.pack(FRAME_MAGIC, 1, 0, frame_id, time.time() * 1000)
+            send_times[frame_id] = time.perf_counter()
+            await websocket.send(header + jpeg)
+            stats.sent += 1
+            frame_id += 1
+            # 按固定节拍发送，不因处理慢而降低发送速率
+            next_time = started + frame_id * interval
+            await asyncio.sleep(max(0.0, next_time - time.perf_counter()))
+
+        # 等待在途帧的回复
+        await asyncio.sleep(grace)
+        receiver.cancel()
+
+async def fetch_server_stats(url):
+    async with websockets.connect(url) as websocket:
+        await websocket.send('stats')
+        async for message in websocket:
+            if message.startswith('stats:'):
+                return json.loads(message[len('stats:'):])
+
+async def run_load(url, clients, fps, duration, grace, jpeg, protocol='legacy', coalesce=False):
+    all_stats = [ClientStats() for _ in range(clients)]
+    started = time.perf_counter()
+    await asyncio.gather(*(run_client(url, jpeg, fps, duration, grace, stats, protocol, coalesce) for stats in all_stats))
+    elapsed = time.perf_counter() - started - grace
+
+    sent = sum(stats.sent for stats in all_stats)
+    answered = sum(stats.answered for stats in all_stats)
+    latencies = np.array([value for stats in all_stats for value in stats.latencies])
+    percentiles = np.percentile(latencies, [50, 95, 99]) if len(latencies) else [0.0, 0.0, 0.0]
+    return {
+        'sent': sent,
+        'answered': answered,
+        'busy': sum(stats.busy for stats in all_stats),
+        'errors': sum(stats.errors for stats in all_stats),
+        'throughput_fps': answered / elapsed if elapsed > 0 else 0.0,
+        'drop_rate': 1 - answered / sent if sent else 0.0,
+        'latency_ms': {
+            'p50': float(percentiles[0]),
+            'p95': float(percentiles[1]),
+            'p99': float(percentiles[2]),
+            'mean': float(latencies.mean()) if len(latencies) else 0.0
+        }
+    }
+
+async def run_benchmark(args):
+    jpeg = synthetic_jpeg(args.image)
+    server = None
+    url = args.url
+    if url is None:
+        # 在本进程内启动服务，stub 模式下注入桩检测器
+        if args.mode == 'stub':
+            python_server._detector = StubDetector(parse_stage_ms(args.stub_call_ms), parse_stage_ms(args.stub_frame_ms))
+        await python_server.model_loader.load(python_server.inference_pool)
+        if not python_server.model_loader.ready:
+            raise RuntimeError(f"模型加载失败: {python_server.model_loader.status()}")
+        server = await websockets.serve(python_server.process_frames, 'localhost', args.port,
+                                        max_size=1024 * 1024 * 2, max_queue=16)
+        url = f"ws://localhost:{args.port}"
+
+    try:
+        results = await run_load(url, args.clients, args.fps, args.duration, args.grace, jpeg,
+                                 args.protocol, args.coalesce)
+        results['server'] = await fetch_server_stats(url)
+    finally:
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+
+    results['config'] = {
+        'mode': 'external' if args.url else args.mode,
+        'url': url,
+        'clients': args.clients,
+        'target_fps': args.fps,
+        'duration': args.duration,
+        'frame_bytes': len(jpeg),
+        'protocol': args.protocol,
+        'coalesce': args.coalesce,
+        'executor': python_server.EXECUTOR_KIND,
+        'batch_max_size': python_server.BATCH_MAX_SIZE,
+        'frame_mode': python_server.FRAME_MODE
+    }
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="情绪识别服务吞吐和延迟基准测试")
+    parser.add_argument('--mode', choices=['stub', 'real'], default='stub', help="本进程内启动的服务使用桩检测器还是真实模型")
+    parser.add_argument('--url', help="压测已运行的服务(如 ws://localhost:8765)，指定后不在本进程内启动服务")
+    parser.add_argument('--port', type=int, default=8790, help="本进程内服务的端口")
+    parser.add_argument('--clients', type=int, default=4, help="并发客户端数")
+    parser.add_argument('--fps', type=float, default=15, help="每个客户端的发送帧率")
+    parser.add_argument('--duration', type=float, default=10, help="发送时长(秒)")
+    parser.add_argument('--grace', type=float, default=2, help="停止发送后等待在途回复的时长(秒)")
+    parser.add_argument('--image', help="作为测试帧的图片，默认生成随机图像")
+    parser.add_argument('--stub-call-ms', default='', help="桩检测器每次调用的耗时，如 faces=4,emotions=2")
+    parser.add_argument('--stub-frame-ms', default='', help="桩检测器每帧的耗时，如 faces=6,emotions=4")
+    parser.add_argument('--protocol', choices=['legacy', 'json'], default='legacy', help="结果消息格式")
+    parser.add_argument('--coalesce', action='store_true', help="json格式下合并积压的结果")
+    parser.add_argument('--json', help="把结果保存为JSON文件")
+    args = parser.parse_args()
+
+    # 压测期间逐帧日志会严重影响结果
+    logging.getLogger().setLevel(logging.WARNING)
+    results = asyncio.run(run_benchmark(args))
+
+    latency = results['latency_ms']
+    print(f"发送 {results['sent']} 帧, 收到回复 {results['answered']} 帧, 繁忙 {results['busy']}, 错误 {results['errors']}")
+    print(f"吞吐: {results['throughput_fps']:.1f} 帧/秒, 丢帧率: {results['drop_rate'] * 100:.1f}%")
+    print(f"端到端延迟(ms): p50 {latency['p50']:.1f}, p95 {latency['p95']:.1f}, p99 {latency['p99']:.1f}")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"结果已保存到 {os.path.abspath(args.json)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+"""
+ONNX Runtime 推理后端 - 把Detector中的面部检测(RetinaFace)、地标(Mobilenet)和情绪(resmasknet)网络
+导出为ONNX，在CPU上用ONNX Runtime推理，可选int8动态量化；AU模型(xgb)不是torch网络，保持不变
+
+用法示例:
+    # 导出ONNX模型(同时生成int8量化版本)
+    python onnx_backend.py export --model-dir onnx_models --quantize
+    # 在参考图片上对比ONNX与PyTorch的输出
+    python onnx_backend.py check --model-dir onnx_models --images images/ --quantized
+    # 服务使用ONNX后端
+    MF_BACKEND=onnx MF_ONNX_INT8=1 python python_server.py
+
+替换只发生在网络的前向计算这一层，前后处理仍由feat完成，因此两个后端的结果格式完全相同。
+模型文件不存在时服务会在首次构建Detector时自动导出。
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+
+ONNX_OPSET = 13
+
+# 需要替换的网络：Detector上的属性路径、导出用的示例输入形状、输入的可变维度
+# feat版本不同时属性路径可能不同，找不到的网络保持PyTorch推理
+ONNX_MODELS = {
+    'faces': ('face_detector.net', (1, 3, 480, 640), {0: 'batch', 2: 'height', 3: 'width'}),
+    'landmarks': ('landmark_detector', (1, 3, 224, 224), {0: 'batch'}),
+    'emotions': ('emotion_model.model', (1, 3, 224, 224), {0: 'batch'})
+}
+
+# 一致性检查的容差：人脸框IoU下限、情绪概率最大绝对误差、地标平均误差(像素)
+PARITY_MIN_FACE_IOU = 0.9
+PARITY_MAX_PROB_DIFF = 0.05
+PARITY_MAX_LANDMARK_PX = 2.0
+
+def model_path(model_dir, name, quantized=False):
+    return os.path.join(model_dir, f"{name}.int8.onnx" if quantized else f"{name}.onnx")
+
+def _resolve(detector, path):
+    """按属性路径找到网络所在的对象和属性名"""
+    parts = path.split('.')
+    parent = detector
+    for part in parts[:-1]:
+        parent = getattr(parent, part)
+    getattr(parent, parts[-1])
+    return parent, parts[-1]
+
+def _replace(parent, attr, value):
+    """替换属性；父对象是torch模块时先从子模块表中移除，否则torch不允许赋值非模块对象"""
+    modules = getattr(parent, '_modules', None)
+    if isinstance(modules, dict):
+        modules.pop(attr, None)
+    setattr(parent, attr, value)
+
+def _output_axes(outputs):
+    """输出的可变维度：批次维，以及三维以上输出的第二维(如RetinaFace的锚框数随输入尺寸变化)"""
+    axes = {}
+    for i, output in enumerate(outputs):
+        dims = {0: 'batch'}
+        if output.dim() > 2:
+            dims[1] = f"output{i}_len"
+        axes[f"output{i}"] = dims
+    return axes
+
+def export_models(detector, model_dir, quantize=False, names=None):
+    """把Detector中的网络导出为ONNX，quantize 为True时同时生成int8动态量化的模型，返回导出的网络名"""
+    import torch
+
+    os.makedirs(model_dir, exist_ok=True)
+    exported = []
+    for name in names or ONNX_MODELS:
+        attr_path, shape, input_axes = ONNX_MODELS[name]
+        try:
+            parent, attr = _resolve(detector, attr_path)
+        except AttributeError:
+            logging.warning(f"Detector中没有 {attr_path}，跳过 {name} 网络的导出")
+            continue
+        module = getattr(parent, attr)
+        module.eval()
+        dummy = torch.randn(*shape)
+        with torch.no_grad():
+            sample = module(dummy)
+        outputs = list(sample) if isinstance(sample, (tuple, list)) else [sample]
+        output_axes = _output_axes(outputs)
+
+        path = model_path(model_dir, name)
+        started = time.perf_counter()
+        torch.onnx.export(
+            module, dummy, path,
+            opset_version=ONNX_OPSET,
+            input_names=['input'],
+            output_names=list(output_axes),
+            dynamic_axes={'input': input_axes, **output_axes}
+        )
+        if quantize:
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+            quantize_dynamic(path, model_path(model_dir, name, True), weight_type=QuantType.QInt8)
+        logging.info(f"已导出 {name} 网络: {path}{' (含int8版本)' if quantize else ''}, "
+                     f"用时 {time.perf_counter() - started:.2f} 秒")
+        exported.append(name)
+    return exported
+
+class OnnxModule:
+    """用ONNX Runtime会话代替torch网络的前向计算，输入输出仍是torch张量，其他属性转给原网络"""
+
+    def __init__(self, path, module, threads=0):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        self.module = module
+        self.path = path
+
+    def __call__(self, x, *args, **kwargs):
+        import torch
+
+        feed = x.detach().cpu().numpy().astype(np.float32, copy=False)
+        outputs = tuple(torch.from_numpy(output) for output in self.session.run(None, {self.input_name: feed}))
+        return outputs[0] if len(outputs) == 1 else outputs
+
+    forward = __call__
+
+    def eval(self):
+        return self
+
+    def to(self, *args, **kwargs):
+        return self
+
+    def __getattr__(self, name):
+        module = self.__dict__.get('module')
+        if module is None:
+            raise AttributeError(name)
+        return getattr(module, name)
+
+def apply_onnx_backend(detector, model_dir, quantized=False, threads=0):
+    """把Detector中的网络替换为ONNX Runtime推理，缺少的模型文件先导出，返回已替换的网络名"""
+    replaced = []
+    for name, (attr_path, _, _) in ONNX_MODELS.items():
+        try:
+            parent, attr = _resolve(detector, attr_path)
+        except AttributeError:
+            logging.warning(f"Detector中没有 {attr_path}，{name} 网络保持PyTorch推理")
+            continue
+        path = model_path(model_dir, name, quantized)
+        if not os.path.exists(path):
+            logging.info(f"未找到 {path}，开始导出")
+            export_models(detector, model_dir, quantized, [name])
+        _replace(parent, attr, OnnxModule(path, getattr(parent, attr), threads))
+        replaced.append(name)
+    logging.info(f"ONNX Runtime后端已启用{'(int8)' if quantized else ''}: {', '.join(replaced) or '无'}")
+    return replaced
+
+def _iou(a, b):
+    x1, y1 = max(a[0], b[0]), max(a[1], b[1])
+    x2, y2 = min(a[2], b[2]), min(a[3], b[3])
+    inter = max(0.0, x2 - x1) * max(0.0, y2 - y1)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+def _detect(python_server, detector, img, face_hints=None):
+    """用指定的Detector执行与服务相同的检测流程"""
+    python_server._detector = detector
+    started = time.perf_counter()
+    result = python_server.run_detection_batch([img], face_hints=face_hints)[0]
+    return result, time.perf_counter() - started
+
+def parity_check(image_paths, model_dir, quantized=False):
+    """在参考图片上对比ONNX与PyTorch后端的输出，返回每张图片的比较结果和是否全部在容差内
+
+    地标和情绪使用PyTorch检测到的人脸框作为提示，分别衡量每个网络自身的误差
+    """
+    import cv2
+    import python_server
+
+    python_server.ONNX_MODEL_DIR = model_dir
+    python_server.ONNX_QUANTIZE = quantized
+    eager = python_server.build_detector('eager')
+    onnx = python_server.build_detector('onnx')
+
+    rows = []
+    passed = True
+    for path in image_paths:
+        img = cv2.imread(path)
+        if img is None:
+            logging.warning(f"无法读取图片: {path}")
+            continue
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        expected, eager_seconds = _detect(python_server, eager, img)
+        detected, onnx_seconds = _detect(python_server, onnx, img)
+        row = {'image': os.path.basename(path), 'eager_ms': eager_seconds * 1000, 'onnx_ms': onnx_seconds * 1000}
+        if expected is None or detected is None:
+            row['ok'] = expected is None and detected is None
+            row['note'] = '两个后端均未检测到面部' if row['ok'] else '只有一个后端检测到面部'
+        else:
+            actual, _ = _detect(python_server, onnx, img, face_hints=[expected['faces']])
+            row['face_iou'] = _iou(expected['faces'][0], detected['faces'][0])
+            expected_probs = np.asarray(expected['emotions'][0], dtype=float)
+            actual_probs = np.asarray(actual['emotions'][0], dtype=float)
+            row['prob_diff'] = float(np.abs(expected_probs - actual_probs).max())
+            row['top1_match'] = int(np.argmax(expected_probs)) == int(np.argmax(actual_probs))
+            row['landmark_px'] = float(np.abs(
+                np.asarray(expected['landmarks'][0], dtype=float) - np.asarray(actual['landmarks'][0], dtype=float)
+            ).mean())
+            row['ok'] = (
+                row['face_iou'] >= PARITY_MIN_FACE_IOU
+                and row['prob_diff'] <= PARITY_MAX_PROB_DIFF
+                and row['top1_match']
+                and row['landmark_px'] <= PARITY_MAX_LANDMARK_PX
+            )
+        passed = passed and row['ok']
+        rows.append(row)
+    return rows, passed
+
+def main():
+    parser = argparse.ArgumentParser(description="ONNX Runtime推理后端：导出模型和一致性检查")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export_parser = subparsers.add_parser('export', help="把面部/地标/情绪网络导出为ONNX")
+    export_parser.add_argument('--model-dir', default='onnx_models', help="ONNX模型输出目录")
+    export_parser.add_argument('--quantize', action='store_true', help="同时生成int8动态量化的模型")
+    check_parser = subparsers.add_parser('check', help="在参考图片上对比ONNX与PyTorch的输出")
+    check_parser.add_argument('--model-dir', default='onnx_models', help="ONNX模型目录，缺少的模型会先导出")
+    check_parser.add_argument('--images', default='images', help="参考图片目录")
+    check_parser.add_argument('--quantized', action='store_true', help="检查int8量化的模型")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.command == 'export':
+        import python_server
+        export_models(python_server.build_detector('eager'), args.model_dir, args.quantize)
+        return
+
+    from batch_analyze import list_images
+    rows, passed = parity_check(list_images(args.images), args.model_dir, args.quantized)
+    for row in rows:
+        if 'face_iou' in row:
+            print(f"{row['image']}: 人脸框IoU {row['face_iou']:.3f}, 情绪概率最大误差 {row['prob_diff']:.4f}, "
+                  f"主情绪{'一致' if row['top1_match'] else '不一致'}, 地标平均误差 {row['landmark_px']:.2f}px, "
+                  f"耗时 {row['eager_ms']:.1f}ms -> {row['onnx_ms']:.1f}ms {'通过' if row['ok'] else '未通过'}")
+        else:
+            print(f"{row['image']}: {row['note']} {'通过' if row['ok'] else '未通过'}")
+    print(f"一致性检查{'通过' if passed else '未通过'}: {len(rows)} 张图片")
+    sys.exit(0 if passed else 1)
+
+if __name__ == "__main__":
+    main()
@@ -1,36 +1,33 @@
 import asyncio
 import base64
+import bisect
+import collections
+import copy
 import datetime
+import io
+import itertools
+import json
 import logging
+import math
+import multiprocessing
+import os
+import signal
+import socket
+import sqlite3
 import ssl
+import struct
+import sys
+import threading
+import time
+import uuid
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import cv2
-import matplotlib
-import matplotlib.pyplot as plt
 import numpy as np
 import websockets
-from feat import Detector
-from reportlab.lib import colors
-from reportlab.lib.pagesizes import letter
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import inch
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Image
 from websockets.exceptions import ConnectionClosed
-
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Image
-from reportlab.lib import colors
-from reportlab.lib.units import inch
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-import datetime
-import logging
-import os
-import matplotlib.pyplot as plt
-
-matplotlib.use('Agg')  # 设置后端为Agg，避免GUI相关问题
+from session_log import SessionEventLog
 
 # 配置日志
 logging.basicConfig(
@@ -38,18 +35,274 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
-# 初始化SSL和Detector
+# 进程启动时刻，用于记录启动耗时和首帧耗时
+PROCESS_START = time.perf_counter()
+
+# 初始化SSL；Detector(feat/torch)导入和构建较慢，启动监听后在后台加载，见 get_detector/ModelLoader
 context = ssl.create_default_context()
 context.minimum_version = ssl.TLSVersion.TLSv1_2
-detector = Detector(
-    face_model="RetinaFace",
-    landmark_model="Mobilenet",
-    au_model="xgb",
-    emotion_model="resmasknet"
+EMOTION_MODEL = "resmasknet"
+# 推理后端：eager 为PyTorch直接推理；onnx 把面部/地标/情绪网络导出为ONNX后用ONNX Runtime推理，
+# 模型文件缓存在 MF_ONNX_DIR，MF_ONNX_INT8=1 时使用int8动态量化的模型(见 onnx_backend.py)
+INFERENCE_BACKENDS = ('eager', 'onnx')
+INFERENCE_BACKEND = os.environ.get('MF_BACKEND', 'eager')
+ONNX_MODEL_DIR = os.environ.get('MF_ONNX_DIR', 'onnx_models')
+ONNX_QUANTIZE = os.environ.get('MF_ONNX_INT8', '0') == '1'
+_detector = None
+_detector_lock = threading.Lock()
+
+def build_detector(backend=None):
+    """导入feat并构建一个新的Detector；onnx 后端把其中的面部/地标/情绪网络换成ONNX Runtime推理"""
+    backend = backend or INFERENCE_BACKEND
+    if backend not in INFERENCE_BACKENDS:
+        raise ValueError(f"未知的推理后端: {backend}")
+    from feat import Detector
+    detector = Detector(
+        face_model="RetinaFace",
+        landmark_model="Mobilenet",
+        au_model="xgb",
+        emotion_model=EMOTION_MODEL
+    )
+    if TORCH_THREADS > 0:
+        import torch
+        torch.set_num_threads(TORCH_THREADS)
+    if backend == 'onnx':
+        from onnx_backend import apply_onnx_backend
+        apply_onnx_backend(detector, ONNX_MODEL_DIR, ONNX_QUANTIZE, TORCH_THREADS)
+    return detector
+
+def get_detector():
+    """首次调用时构建Detector，之后复用同一个实例(进程池模式下每个进程各自构建)"""
+    global _detector
+    if _detector is not None:
+        return _detector
+    with _detector_lock:
+        if _detector is None:
+            _detector = build_detector()
+        return _detector
+
+def _import_report_libs():
+    """报告相关的reportlab模块只在首次生成报告时导入，不拖慢服务启动"""
+    global colors, letter, getSampleStyleSheet, ParagraphStyle, inch
+    global SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
+    global pdfmetrics, TTFont, VerticalBarChart, Drawing, Group, String
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import letter
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.lib.units import inch
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    from reportlab.graphics.charts.barcharts import VerticalBarChart
+    from reportlab.graphics.shapes import Drawing, Group, String
+
+EMOTION_COLUMNS = ['anger', 'disgust', 'fear', 'happiness', 'sadness', 'surprise', 'neutral']
+AU_COLUMNS = [
+    'AU01', 'AU02', 'AU04', 'AU05', 'AU06', 'AU07', 'AU09', 'AU10', 'AU11', 'AU12',
+    'AU14', 'AU15', 'AU17', 'AU20', 'AU23', 'AU24', 'AU25', 'AU26', 'AU28', 'AU43'
+]
+
+# 逐帧流水线的各阶段及其依赖的阶段
+PIPELINE_STAGES = {
+    'faces': (),
+    'landmarks': ('faces',),
+    'aus': ('landmarks',),
+    # resmasknet直接对人脸框做情绪识别，只有基于地标特征的模型才需要地标
+    'emotions': ('faces',) if EMOTION_MODEL == 'resmasknet' else ('faces', 'landmarks')
+}
+ALL_STAGES = frozenset(PIPELINE_STAGES)
+
+# 会话可选择的输出项及其直接需要的阶段
+PIPELINE_OUTPUTS = {
+    'emotion': 'emotions',
+    'aus': 'aus',
+    'landmarks': 'landmarks'
+}
+
+# 默认输出项(逗号分隔)以及AU的计算间隔(每N帧计算一次)
+DEFAULT_OUTPUTS = os.environ.get('MF_OUTPUTS', 'emotion').split(',')
+AU_INTERVAL = int(os.environ.get('MF_AU_INTERVAL', 1))
+
+# 微批处理调度配置：每批最多帧数、首帧入队后最长等待时间(毫秒)
+BATCH_MAX_SIZE = int(os.environ.get('MF_BATCH_MAX_SIZE', 16))
+BATCH_MAX_WAIT_MS = float(os.environ.get('MF_BATCH_MAX_WAIT_MS', 15))
+
+# 推理执行池配置：池类型(thread/process)、工作者数量、全局在途帧上限
+EXECUTOR_KIND = os.environ.get('MF_EXECUTOR', 'thread')
+EXECUTOR_WORKERS = int(os.environ.get('MF_EXECUTOR_WORKERS', 2))
+MAX_IN_FLIGHT = int(os.environ.get('MF_MAX_IN_FLIGHT', 32))
+
+# 多进程服务：工作进程数(1为单进程)，各进程通过 SO_REUSEPORT 共同监听同一端口，每个进程有自己的Detector
+# 每个进程的torch线程数，0表示按 CPU核数/工作进程数 自动分配
+SERVER_WORKERS = int(os.environ.get('MF_WORKERS', 1))
+TORCH_THREADS = int(os.environ.get('MF_TORCH_THREADS', 0))
+WORKER_RESTART_DELAY = 1.0
+
+# 报告字体文件和默认的报告输出目录
+REPORT_FONT_PATH = os.environ.get('MF_REPORT_FONT', 'simsun.ttf')
+REPORT_DIR = os.environ.get('MF_REPORT_DIR', '.')
+
+# 后台报告生成线程数
+REPORT_WORKERS = int(os.environ.get('MF_REPORT_WORKERS', 2))
+
+# 周期报告策略：统计有变化时，每个会话至少间隔若干秒、且至少新增N帧有效结果才生成一次(N为0时不生成周期报告)
+REPORT_MIN_INTERVAL = float(os.environ.get('MF_REPORT_MIN_INTERVAL', 5))
+REPORT_EVERY_N_FRAMES = int(os.environ.get('MF_REPORT_EVERY_N_FRAMES', 10))
+
+# 情绪时间序列：原始逐帧概率保留的帧数、降采样时间桶的初始宽度(秒)和桶数上限
+# 桶数用满后相邻两桶合并、桶宽加倍，长时间会话的内存占用保持不变
+TIMELINE_CAPACITY = int(os.environ.get('MF_TIMELINE_CAPACITY', 3600))
+TIMELINE_BUCKET_SECONDS = float(os.environ.get('MF_TIMELINE_BUCKET_SECONDS', 1.0))
+TIMELINE_MAX_BUCKETS = int(os.environ.get('MF_TIMELINE_MAX_BUCKETS', 3600))
+
+# 指标HTTP端点端口(GET /metrics，Prometheus文本格式)，0表示不开启；多进程模式下第i个工作进程使用 端口+i
+METRICS_PORT = int(os.environ.get('MF_METRICS_PORT', 8766))
+# 耗时直方图的分桶上界(秒)
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# 模型预热：加载完成后用合成图像把每个检测阶段各跑若干次
+MODEL_WARMUP_FRAMES = int(os.environ.get('MF_WARMUP_FRAMES', 2))
+
+# 按需降分辨率解码：JPEG短边超过该值的若干倍时直接以1/2、1/4、1/8分辨率解码(0表示始终全分辨率解码)
+DECODE_MIN_SIDE = int(os.environ.get('MF_DECODE_MIN_SIDE', 240))
+REDUCED_DECODE_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+# JPEG中带有图像尺寸的SOF段标记
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+# 帧接收模式：mailbox 只处理最新帧并丢弃积压的旧帧，queue 按到达顺序逐帧处理
+FRAME_MODE = os.environ.get('MF_FRAME_MODE', 'mailbox')
+FRAME_QUEUE_SIZE = 16
+
+# 二进制帧格式：可选帧头 + JPEG原始字节
+# 帧头为魔数b'MF'、版本号、标志位、客户端帧号(uint32)、客户端时间戳(float64, 毫秒)，共16字节，小端序
+# 标志位 FRAME_FLAG_FACE_BOX 表示帧头后紧跟客户端检测到的人脸框(x1, y1, x2, y2, score，float32，裁剪图坐标)
+FRAME_HEADER = struct.Struct('<2sBBId')
+FRAME_MAGIC = b'MF'
+FRAME_FLAG_FACE_BOX = 0x01
+FRAME_FACE_BOX = struct.Struct('<5f')
+
+# 预裁剪人脸的合理性检查阈值：最小边长、最大宽高比、最小灰度标准差
+PRECROP_MIN_SIZE = 48
+PRECROP_MAX_ASPECT = 2.0
+PRECROP_MIN_STD = 8.0
+
+# 人脸跟踪配置：是否默认开启、关键帧间隔(帧)、模板匹配分数下限、搜索窗口相对人脸尺寸的外扩比例
+TRACKING_ENABLED = os.environ.get('MF_TRACKING', '0') == '1'
+KEYFRAME_INTERVAL = int(os.environ.get('MF_KEYFRAME_INTERVAL', 10))
+TRACK_MIN_SCORE = float(os.environ.get('MF_TRACK_MIN_SCORE', 0.7))
+TRACK_SEARCH_MARGIN = 0.5
+
+# 多人脸：情绪模型只需要人脸框时，把一个微批中所有帧的所有人脸按比例外扩后裁剪缩放到统一尺寸，
+# 合成一个批次送入情绪模型，人脸数和图像尺寸都不增加调用次数；每次调用最多的人脸数
+FACE_CROP_SIZE = 320
+FACE_CROP_MARGIN = 0.25
+EMOTION_BATCH_MAX = int(os.environ.get('MF_EMOTION_BATCH', 64))
+# 人脸编号：相邻帧人脸框IoU不低于阈值时视为同一个人，连续若干帧未出现后释放
+FACE_ID_MIN_IOU = float(os.environ.get('MF_FACE_ID_MIN_IOU', 0.3))
+FACE_ID_MAX_MISSED = int(os.environ.get('MF_FACE_ID_MAX_MISSED', 30))
+# 报告中单独列出的人数上限(按出现帧数排序)
+REPORT_MAX_PEOPLE = int(os.environ.get('MF_REPORT_MAX_PEOPLE', 20))
+
+# 近似重复帧缓存：是否默认开启、感知哈希(64位)汉明距离阈值、连续复用的最大帧数、每个会话缓存的帧数
+DEDUP_ENABLED = os.environ.get('MF_DEDUP', '0') == '1'
+DEDUP_THRESHOLD = int(os.environ.get('MF_DEDUP_THRESHOLD', 4))
+DEDUP_MAX_STREAK = int(os.environ.get('MF_DEDUP_MAX_STREAK', 10))
+DEDUP_CACHE_SIZE = int(os.environ.get('MF_DEDUP_CACHE_SIZE', 8))
+
+# 发送端画质自适应：各档位的人脸裁剪尺寸、JPEG质量和帧率，默认档位与发送页原有参数一致
+# 每隔若干秒评估一次：本周期有繁忙拒绝、丢帧率或服务端负载过高时降一档，无丢帧且负载较低时升一档
+QUALITY_LEVELS = (
+    {'size': 112, 'quality': 0.5, 'fps': 0.5},
+    {'size': 160, 'quality': 0.5, 'fps': 1},
+    {'size': 224, 'quality': 0.6, 'fps': 1},
+    {'size': 224, 'quality': 0.7, 'fps': 2},
+    {'size': 224, 'quality': 0.8, 'fps': 5}
 )
+QUALITY_DEFAULT_LEVEL = 2
+QUALITY_EVAL_INTERVAL = float(os.environ.get('MF_QUALITY_INTERVAL', 5))
+QUALITY_MAX_DROP_RATE = 0.2
+QUALITY_HIGH_LOAD = 0.8
+QUALITY_LOW_LOAD = 0.3
+
+# 准入控制：最大会话数(0为不限)、单帧端到端延迟预算、过载时拒绝新连接后建议客户端改连的地址
+# 每个会话每秒最多处理的帧数(0为不限)；过载时各会话按公平份额限速，份额不低于最小帧率
+ADMISSION_MAX_SESSIONS = int(os.environ.get('MF_MAX_SESSIONS', 0))
+ADMISSION_LATENCY_BUDGET_MS = float(os.environ.get('MF_LATENCY_BUDGET_MS', 1000))
+ADMISSION_REDIRECT_URL = os.environ.get('MF_REDIRECT_URL', '')
+ADMISSION_OVERLOAD_LOAD = 0.9
+ADMISSION_EWMA_ALPHA = 0.2
+ADMISSION_STALE_SECONDS = 5.0
+SESSION_MAX_FPS = float(os.environ.get('MF_SESSION_MAX_FPS', 0))
+SESSION_MIN_FPS = 0.5
+SESSION_BURST_FRAMES = 2
+
+# 会话事件日志：逐帧结果追加写入的SQLite文件(默认不记录)、每次提交的最大记录数和最长攒批时间(毫秒)
+# 断线重连的客户端发送 config:{"session_id": ...} 恢复会话统计，报告也可以根据日志重新生成(见 session_log.py)
+# 日志不会自动清理；多进程模式下各工作进程写入同一个文件，由SQLite的文件锁串行提交
+EVENT_LOG_PATH = os.environ.get('MF_EVENT_LOG', '')
+EVENT_LOG_BATCH = int(os.environ.get('MF_EVENT_LOG_BATCH', 256))
+EVENT_LOG_FLUSH_MS = float(os.environ.get('MF_EVENT_LOG_FLUSH_MS', 200))
+
+# 跨会话实时汇总：按秒、按分钟时间桶的个数(即可查询的最长时间范围)、订阅推送间隔(秒)、默认查询窗口(秒)
+ANALYTICS_SECOND_BUCKETS = int(os.environ.get('MF_ANALYTICS_SECONDS', 300))
+ANALYTICS_MINUTE_BUCKETS = int(os.environ.get('MF_ANALYTICS_MINUTES', 1440))
+ANALYTICS_PUSH_INTERVAL = float(os.environ.get('MF_ANALYTICS_PUSH_INTERVAL', 1.0))
+ANALYTICS_DEFAULT_WINDOW = 60
+
+# 结果消息格式：legacy 每帧发送 frame:序号 和情绪文字等多条消息，json 每帧发送一条 result:{...}
+# json 格式下开启合并时，客户端接收跟不上期间积压的结果合并为一条 results:[...]，单条最多合并若干帧
+RESULT_PROTOCOLS = ('legacy', 'json')
+RESULT_PROTOCOL = os.environ.get('MF_RESULT_PROTOCOL', 'legacy')
+RESULT_COALESCE = os.environ.get('MF_RESULT_COALESCE', '0') == '1'
+RESULT_MAX_COALESCE = 32
+
+# 会话可协商的配置项及默认值，客户端发送 config:{json} 修改
+DEFAULT_SESSION_CONFIG = {
+    'precropped': False,
+    'outputs': DEFAULT_OUTPUTS,
+    'au_interval': AU_INTERVAL,
+    'report_delivery': 'file',
+    'tracking': TRACKING_ENABLED,
+    'keyframe_interval': KEYFRAME_INTERVAL,
+    'protocol': RESULT_PROTOCOL,
+    'coalesce': RESULT_COALESCE,
+    'dedup': DEDUP_ENABLED,
+    'adaptive_quality': False
+}
+
+def jpeg_size(data, offset=0):
+    """只解析JPEG段头读取图像尺寸(宽, 高)，不解码像素；不是JPEG或无法解析时返回None"""
+    if data[offset:offset + 2] != b'\xff\xd8':
+        return None
+    i = offset + 2
+    while i + 9 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        if marker in JPEG_SOF_MARKERS:
+            height, width = struct.unpack_from('>HH', data, i + 5)
+            return width, height
+        if 0xD0 <= marker <= 0xD7 or marker == 0x01:
+            i += 2
+            continue
+        i += 2 + struct.unpack_from('>H', data, i + 2)[0]
+    return None
+
+def decode_jpeg(data, offset=0):
+    """解码JPEG字节：图像明显大于模型需要的尺寸时直接按比例缩小解码，返回(BGR图像, 缩小倍数)"""
+    nparr = np.frombuffer(data, np.uint8, offset=offset)
+    size = jpeg_size(data, offset) if DECODE_MIN_SIDE else None
+    if size is not None:
+        for factor, flag in REDUCED_DECODE_FLAGS:
+            if min(size) >= DECODE_MIN_SIDE * factor:
+                return cv2.imdecode(nparr, flag), factor
+    return cv2.imdecode(nparr, cv2.IMREAD_COLOR), 1
 
 def base64_to_cv2(base64_string):
-    """将base64图像转换为cv2格式"""
+    """将base64图像转换为cv2格式，返回(BGR图像, 缩小倍数)"""
     try:
         # 移除base64头部信息（如果存在）
         if ',' in base64_string:
@@ -58,24 +311,1342 @@ def base64_to_cv2(base64_string):
         # 解码base64数据
         img_data = base64.b64decode(base64_string)
         
-        # 转换为numpy数组
-        nparr = np.frombuffer(img_data, np.uint8)
-        
         # 解码图像
-        img_array = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        
-        return img_array
+        return decode_jpeg(img_data)
     except Exception as e:
         logging.error(f"Base64转换错误: {str(e)}")
+        return None, 1
+
+def parse_binary_frame(data):
+    """解析二进制帧头，返回(客户端帧号, 客户端时间戳, 客户端人脸框, JPEG数据偏移)，没有的字段为None"""
+    if len(data) >= FRAME_HEADER.size and data[:2] == FRAME_MAGIC:
+        _, version, flags, frame_id, timestamp = FRAME_HEADER.unpack_from(data)
+        offset = FRAME_HEADER.size
+        face_box = None
+        if flags & FRAME_FLAG_FACE_BOX:
+            face_box = list(FRAME_FACE_BOX.unpack_from(data, offset))
+            offset += FRAME_FACE_BOX.size
+        return frame_id, timestamp, face_box, offset
+    return None, None, None, 0
+
+def jpeg_to_cv2(data, offset=0):
+    """直接从接收缓冲区解码JPEG字节，不经过中间拷贝，返回(BGR图像, 缩小倍数)"""
+    try:
+        return decode_jpeg(data, offset)
+    except Exception as e:
+        logging.error(f"JPEG解码错误: {str(e)}")
+        return None, 1
+
+def is_frame_message(message):
+    """判断消息是否为图像帧：二进制JPEG帧或base64 data URL"""
+    return isinstance(message, bytes) or message.startswith('data:image')
+
+def decode_frame(message):
+    """解码一帧图像消息并转换为RGB格式，返回(RGB图像, 缩小倍数)，失败时图像为None"""
+    if isinstance(message, bytes):
+        _, _, _, offset = parse_binary_frame(message)
+        img_array, scale = jpeg_to_cv2(message, offset)
+    else:
+        img_array, scale = base64_to_cv2(message)
+    if img_array is None:
+        return None, scale
+    # 解码按缩小倍数进行，转换颜色通道时只分配一张同样缩小后的RGB图像
+    return cv2.cvtColor(img_array, cv2.COLOR_BGR2RGB), scale
+
+def precropped_face_box(img_rgb, client_box=None):
+    """客户端已裁剪出人脸时，把整张图(或客户端给出的人脸框)作为人脸框；未通过合理性检查时返回None，改为完整检测"""
+    height, width = img_rgb.shape[:2]
+    if min(height, width) < PRECROP_MIN_SIZE:
+        return None
+    if max(height, width) / min(height, width) > PRECROP_MAX_ASPECT:
+        return None
+    # 纯色或几乎空白的图像不可能是人脸，隔行隔列采样估计灰度标准差即可
+    if img_rgb[::4, ::4].std() < PRECROP_MIN_STD:
         return None
 
-class FrameCounter:
-    def __init__(self):
-        self.count = 0
+    if client_box is not None:
+        x1, y1, x2, y2, score = client_box
+        x1, y1 = max(0.0, x1), max(0.0, y1)
+        x2, y2 = min(float(width), x2), min(float(height), y2)
+        if x2 - x1 >= PRECROP_MIN_SIZE / 2 and y2 - y1 >= PRECROP_MIN_SIZE / 2:
+            return [x1, y1, x2, y2, score]
+    return [0.0, 0.0, float(width), float(height), 1.0]
+
+def crop_face(img_rgb, box, size=FACE_CROP_SIZE, margin=FACE_CROP_MARGIN):
+    """以人脸框为中心按比例外扩成正方形并缩放为 size×size(超出图像的部分用边缘像素填充)，
+    返回裁剪图和人脸框在裁剪图中的坐标"""
+    x1, y1, x2, y2 = (float(v) for v in box[:4])
+    side = max(x2 - x1, y2 - y1, 1.0) * (1 + 2 * margin)
+    left = (x1 + x2 - side) / 2
+    top = (y1 + y2 - side) / 2
+    s = size / side
+    # 裁剪和缩放合并为一次仿射变换
+    matrix = np.float32([[s, 0, -left * s], [0, s, -top * s]])
+    crop = cv2.warpAffine(img_rgb, matrix, (size, size), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+    score = float(box[4]) if len(box) > 4 else 1.0
+    return crop, [(x1 - left) * s, (y1 - top) * s, (x2 - left) * s, (y2 - top) * s, score]
+
+def box_iou(boxes_a, boxes_b):
+    """两组人脸框两两之间的IoU矩阵"""
+    a = np.asarray(boxes_a, dtype=float).reshape(-1, 4)
+    b = np.asarray(boxes_b, dtype=float).reshape(-1, 4)
+    x1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - inter
+    return np.where(union > 0, inter / np.maximum(union, 1e-9), 0.0)
+
+def crop_face_template(img_rgb, box):
+    """截取人脸框内的灰度图作为跟踪模板，人脸框无效时返回None"""
+    height, width = img_rgb.shape[:2]
+    x1, y1 = max(0, int(box[0])), max(0, int(box[1]))
+    x2, y2 = min(width, int(box[2])), min(height, int(box[3]))
+    if x2 - x1 < 8 or y2 - y1 < 8:
+        return None
+    return cv2.cvtColor(img_rgb[y1:y2, x1:x2], cv2.COLOR_RGB2GRAY)
+
+def track_face(img_rgb, template, box, landmarks):
+    """在上一帧人脸位置附近做模板匹配，返回(新人脸框, 平移后的地标, 新模板, 匹配分数)，无法匹配时人脸框为None"""
+    height, width = img_rgb.shape[:2]
+    template_h, template_w = template.shape[:2]
+    x1, y1 = max(0, int(box[0])), max(0, int(box[1]))
+
+    # 只在人脸框外扩一定比例的窗口内搜索
+    margin_x = int(template_w * TRACK_SEARCH_MARGIN)
+    margin_y = int(template_h * TRACK_SEARCH_MARGIN)
+    sx1, sy1 = max(0, x1 - margin_x), max(0, y1 - margin_y)
+    sx2, sy2 = min(width, x1 + template_w + margin_x), min(height, y1 + template_h + margin_y)
+    if sx2 - sx1 < template_w or sy2 - sy1 < template_h:
+        return None, None, template, 0.0
+
+    window = cv2.cvtColor(img_rgb[sy1:sy2, sx1:sx2], cv2.COLOR_RGB2GRAY)
+    scores = cv2.matchTemplate(window, template, cv2.TM_CCOEFF_NORMED)
+    _, score, _, (match_x, match_y) = cv2.minMaxLoc(scores)
+
+    dx, dy = sx1 + match_x - x1, sy1 + match_y - y1
+    new_box = [box[0] + dx, box[1] + dy, box[2] + dx, box[3] + dy, box[4]]
+    new_landmarks = None if landmarks is None else np.asarray(landmarks) + (dx, dy)
+    new_template = window[match_y:match_y + template_h, match_x:match_x + template_w].copy()
+    return new_box, new_landmarks, new_template, float(score)
+
+def frame_hash(img_rgb):
+    """64位差值哈希(dHash)：缩小到9x8灰度图后比较相邻像素，画面几乎不变的帧哈希值相同或只差几位"""
+    gray = cv2.cvtColor(cv2.resize(img_rgb, (9, 8), interpolation=cv2.INTER_AREA), cv2.COLOR_RGB2GRAY)
+    bits = (gray[:, 1:] > gray[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def resolve_pipeline_stages(outputs):
+    """根据需要的输出项解析出必须执行的阶段(包含依赖阶段)，未知输出项抛出ValueError"""
+    unknown = [output for output in outputs if output not in PIPELINE_OUTPUTS]
+    if unknown:
+        raise ValueError(f"未知的输出项: {unknown}")
+
+    stages = set()
+    pending = [PIPELINE_OUTPUTS[output] for output in outputs]
+    while pending:
+        stage = pending.pop()
+        if stage not in stages:
+            stages.add(stage)
+            pending.extend(PIPELINE_STAGES[stage])
+    return frozenset(stages)
+
+def _add_timing(timings, stage, started):
+    """把从 started 到现在的耗时累计到 timings[stage]"""
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - started
+
+def _take(batch, positions):
+    # 选取批次中的部分帧，全部选中时直接复用原批次避免拷贝
+    return batch if len(positions) == len(batch) else batch[positions]
+
+def run_detection_batch(images, face_hints=None, stage_sets=None, landmark_hints=None, timings=None):
+    """对一批RGB图像按需执行各检测阶段，返回每帧的结果字典，未检测到面部时为None
+
+    face_hints 为每帧已知的人脸框列表(如客户端预裁剪或跟踪得到的人脸)，有人脸框的帧跳过面部检测；
+    stage_sets 为每帧需要执行的阶段集合，默认执行全部阶段；
+    landmark_hints 为每帧已知的地标列表(如跟踪得到的地标)，有地标的帧跳过地标提取；
+    传入字典 timings 时累计各阶段的耗时(秒)
+    """
+    detector = get_detector()
+    results = [None] * len(images)
+    if face_hints is None:
+        face_hints = [None] * len(images)
+    if stage_sets is None:
+        stage_sets = [ALL_STAGES] * len(images)
+    if landmark_hints is None:
+        landmark_hints = [None] * len(images)
+
+    # 情绪模型只需要人脸框时，各尺寸分组的人脸攒到最后统一裁剪成一个批次
+    crop_emotions = 'landmarks' not in PIPELINE_STAGES['emotions']
+    pending_emotions = []
+
+    # 只有尺寸相同的图像才能堆叠成一个批次，按尺寸分组
+    groups = {}
+    for index, img in enumerate(images):
+        groups.setdefault(img.shape, []).append(index)
+
+    for indices in groups.values():
+        batch = np.stack([images[i] for i in indices])
+        faces = [face_hints[i] for i in indices]
+        stages = [stage_sets[i] for i in indices]
+
+        # 面部检测，只对没有人脸框提示的帧执行
+        to_detect = [k for k, frame_faces in enumerate(faces) if frame_faces is None]
+        if to_detect:
+            started = time.perf_counter()
+            for k, frame_faces in zip(to_detect, detector.detect_faces(_take(batch, to_detect))):
+                faces[k] = frame_faces
+            _add_timing(timings, 'faces', started)
+
+        # 只有检测到面部的帧才进入后续阶段
+        frame_results = {
+            k: {'faces': faces[k], 'landmarks': landmark_hints[indices[k]], 'aus': None, 'emotions': None}
+            for k, frame_faces in enumerate(faces) if len(frame_faces) > 0
+        }
+
+        # 地标提取，已有地标的帧跳过
+        need = [k for k in frame_results if 'landmarks' in stages[k] and frame_results[k]['landmarks'] is None]
+        if need:
+            started = time.perf_counter()
+            landmarks = detector.detect_landmarks(_take(batch, need), [faces[k] for k in need])
+            for k, frame_landmarks in zip(need, landmarks):
+                frame_results[k]['landmarks'] = frame_landmarks
+            _add_timing(timings, 'landmarks', started)
+
+        # AU分析
+        need = [k for k in frame_results if 'aus' in stages[k]]
+        if need:
+            started = time.perf_counter()
+            aus = detector.detect_aus(_take(batch, need), [frame_results[k]['landmarks'] for k in need])
+            for k, frame_aus in zip(need, aus):
+                frame_results[k]['aus'] = np.asarray(frame_aus).reshape(-1, len(AU_COLUMNS))
+            _add_timing(timings, 'aus', started)
+
+        # 情绪识别
+        need = [k for k in frame_results if 'emotions' in stages[k]]
+        if need and crop_emotions:
+            pending_emotions.extend((frame_results[k], batch[k]) for k in need)
+        elif need:
+            started = time.perf_counter()
+            landmarks = None
+            if 'landmarks' in PIPELINE_STAGES['emotions']:
+                landmarks = [frame_results[k]['landmarks'] for k in need]
+            emotions = detector.detect_emotions(
+                frame=_take(batch, need),
+                facebox=[faces[k] for k in need],
+                landmarks=landmarks
+            )
+            for k, frame_emotions in zip(need, emotions):
+                frame_results[k]['emotions'] = np.asarray(frame_emotions).reshape(-1, len(EMOTION_COLUMNS))
+            _add_timing(timings, 'emotions', started)
+
+        for k, frame_result in frame_results.items():
+            results[indices[k]] = frame_result
+
+    if pending_emotions:
+        started = time.perf_counter()
+        detect_face_emotions(detector, pending_emotions)
+        _add_timing(timings, 'emotions', started)
+
+    return results
+
+def detect_face_emotions(detector, items):
+    """对 (帧结果, 图像) 列表中的全部人脸做情绪识别：统一裁剪后按 EMOTION_BATCH_MAX 分批调用情绪模型，
+    结果按人脸顺序写回各帧的 emotions"""
+    crops, boxes, counts = [], [], []
+    for frame_result, img in items:
+        counts.append(len(frame_result['faces']))
+        for face in frame_result['faces']:
+            crop, box = crop_face(img, face)
+            crops.append(crop)
+            boxes.append(box)
+
+    probs = []
+    for start in range(0, len(crops), EMOTION_BATCH_MAX):
+        chunk = slice(start, start + EMOTION_BATCH_MAX)
+        emotions = detector.detect_emotions(
+            frame=np.stack(crops[chunk]),
+            facebox=[[box] for box in boxes[chunk]],
+            landmarks=None
+        )
+        probs.extend(np.asarray(face_emotions).reshape(-1, len(EMOTION_COLUMNS))[0] for face_emotions in emotions)
+
+    offset = 0
+    for (frame_result, _), count in zip(items, counts):
+        frame_result['emotions'] = np.asarray(probs[offset:offset + count]).reshape(-1, len(EMOTION_COLUMNS))
+        offset += count
+
+def timed_detection_batch(*args):
+    """执行 run_detection_batch 并返回(结果, 各阶段耗时)，耗时随结果一起返回，进程池模式下也能在主进程汇总"""
+    timings = {}
+    results = run_detection_batch(*args, timings=timings)
+    return results, timings
+
+def prepare_frame(job):
+    """在工作进程中解码一帧并完成去重哈希、预裁剪检查和跟踪，返回(RGB图像, 准备结果)
+
+    job 由主进程根据会话状态生成：message 为原始帧消息，dedup_keys 为可复用的缓存哈希，
+    track 为跟踪用的(模板, 人脸框, 地标)，不需要跟踪时为None
+    """
+    outcome = {'status': 'ok', 'frame_key': None, 'faces': None, 'landmarks': None,
+               'tracked': None, 'keyframe': False, 'detect': True, 'timings': {}}
+    started = time.perf_counter()
+    img_rgb, outcome['scale'] = decode_frame(job['message'])
+    outcome['timings']['decode_jpeg' if isinstance(job['message'], bytes) else 'decode_base64'] = \
+        time.perf_counter() - started
+    if img_rgb is None:
+        outcome['status'] = 'decode_failed'
+        return None, outcome
+
+    if job['dedup']:
+        key = outcome['frame_key'] = frame_hash(img_rgb)
+        if any(bin(cached ^ key).count('1') <= job['dedup_threshold'] for cached in job['dedup_keys']):
+            outcome['detect'] = False
+            return img_rgb, outcome
+
+    if job['precropped']:
+        client_box = job['client_box']
+        if client_box is not None and outcome['scale'] != 1:
+            client_box = [value / outcome['scale'] for value in client_box[:4]] + [client_box[4]]
+        face_box = precropped_face_box(img_rgb, client_box)
+        if face_box is not None:
+            outcome['faces'] = [face_box]
+        else:
+            outcome['precrop_rejected'] = True
+
+    # 与主进程的处理顺序相同：已有预裁剪人脸框时不跟踪，需要关键帧或跟踪失败时做完整检测并返回新模板
+    if outcome['faces'] is None and job['track'] is None:
+        outcome['keyframe'] = job['keyframe']
+    elif outcome['faces'] is None:
+        started = time.perf_counter()
+        tracked = outcome['tracked'] = track_face(img_rgb, *job['track'])
+        outcome['timings']['track'] = time.perf_counter() - started
+        box, landmarks, _, score = tracked
+        if box is not None and score >= job['min_score']:
+            outcome['faces'] = [box]
+            if landmarks is not None:
+                outcome['landmarks'] = [landmarks]
+        else:
+            outcome['keyframe'] = True
+    return img_rgb, outcome
+
+def timed_frame_batch(jobs):
+    """进程池模式的批处理：解码、去重哈希、预裁剪检查、跟踪和检测都在同一个工作进程中完成，
+    图像不跨进程传递，只返回每帧的准备结果(含检测结果和关键帧的跟踪模板)和各检测阶段的耗时"""
+    prepared = [prepare_frame(job) for job in jobs]
+    pending = [i for i, (img_rgb, outcome) in enumerate(prepared) if img_rgb is not None and outcome['detect']]
+    timings = {}
+    results = run_detection_batch(
+        [prepared[i][0] for i in pending],
+        [prepared[i][1]['faces'] for i in pending],
+        [jobs[i]['stages'] for i in pending],
+        [prepared[i][1]['landmarks'] for i in pending],
+        timings=timings
+    ) if pending else []
+    for i, detection in zip(pending, results):
+        img_rgb, outcome = prepared[i]
+        outcome['detection'] = detection
+        if outcome['keyframe'] and detection is not None and len(detection['faces']) == 1:
+            outcome['template'] = crop_face_template(img_rgb, detection['faces'][0])
+    return [outcome for _, outcome in prepared], timings
+
+class Histogram:
+    """固定分桶的耗时直方图(秒)，记录一次只做一次二分查找和几次加法"""
+
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def quantile(self, q):
+        """按分桶估算分位数，返回所在桶的上界(超过最大桶时返回最大上界)"""
+        if self.count == 0:
+            return 0.0
+        target = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return bound
+        return self.buckets[-1]
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean_ms': self.sum / self.count * 1000 if self.count else 0.0,
+            'p50_ms': self.quantile(0.5) * 1000,
+            'p95_ms': self.quantile(0.95) * 1000
+        }
+
+class MetricsRegistry:
+    """进程内指标：各阶段耗时直方图、计数器和读取时才计算的仪表值
+
+    所有更新都在事件循环线程中进行(执行池中测得的耗时随结果返回后再记录)，因此不需要加锁
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = collections.Counter()
+        self.gauges = {}
+
+    def observe(self, stage, seconds):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = Histogram()
+        histogram.observe(seconds)
+
+    def inc(self, name, value=1):
+        self.counters[name] += value
+
+    def gauge(self, name, func):
+        """注册仪表值，func 在输出指标时调用"""
+        self.gauges[name] = func
+
+    def summary(self):
+        return {stage: histogram.summary() for stage, histogram in self.histograms.items()}
+
+    def render_prometheus(self):
+        """输出Prometheus文本格式"""
+        lines = [
+            '# HELP mf_stage_duration_seconds Duration of each processing stage.',
+            '# TYPE mf_stage_duration_seconds histogram'
+        ]
+        for stage, histogram in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f'mf_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'mf_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+            lines.append(f'mf_stage_duration_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+            lines.append(f'mf_stage_duration_seconds_count{{stage="{stage}"}} {histogram.count}')
+        for name, value in sorted(self.counters.items()):
+            lines.append(f'# TYPE mf_{name}_total counter')
+            lines.append(f'mf_{name}_total {value}')
+        for name, func in sorted(self.gauges.items()):
+            try:
+                value = float(func())
+            except Exception:
+                continue
+            lines.append(f'# TYPE mf_{name} gauge')
+            lines.append(f'mf_{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+
+class InferencePool:
+    """有界推理执行池：解码和检测在线程/进程池中执行，事件循环只负责收发消息"""
+
+    def __init__(self, kind=EXECUTOR_KIND, workers=EXECUTOR_WORKERS, max_in_flight=MAX_IN_FLIGHT):
+        self.kind = kind
+        self.workers = max(1, workers)
+        self.max_in_flight = max(1, max_in_flight)
+        self.in_flight = 0
+        self.rejected = 0
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.kind == 'process':
+                # 每个进程导入本模块时各自持有一个Detector，进程启动时先加载并预热
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=warm_up_models)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='inference')
+        return self._executor
+
+    @property
+    def saturated(self):
+        return self.in_flight >= self.max_in_flight
+
+    def try_acquire(self):
+        """为一帧占用在途名额，池已饱和时返回False，由调用方通知客户端"""
+        if self.saturated:
+            self.rejected += 1
+            return False
+        self.in_flight += 1
+        return True
+
+    def release(self):
+        self.in_flight = max(0, self.in_flight - 1)
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._get_executor(), func, *args)
+
+    def get_metrics(self):
+        return {
+            'kind': self.kind,
+            'workers': self.workers,
+            'max_in_flight': self.max_in_flight,
+            'in_flight': self.in_flight,
+            'saturated': self.saturated,
+            'rejected': self.rejected
+        }
+
+inference_pool = InferencePool()
+
+def warm_up_models(frames=MODEL_WARMUP_FRAMES):
+    """加载模型并用合成图像预热各检测阶段，让首个真实帧不再承担初始化开销"""
+    get_detector()
+    size = 224
+    img = np.random.default_rng(0).integers(0, 256, (size, size, 3), dtype=np.uint8)
+    # 合成图像上通常检测不到人脸，额外给出人脸框提示，保证地标、AU、情绪阶段也被执行
+    box = [size * 0.2, size * 0.2, size * 0.8, size * 0.8, 1.0]
+    for _ in range(frames):
+        run_detection_batch([img])
+        run_detection_batch([img], face_hints=[[box]])
+
+class ModelLoader:
+    """服务启动后在后台加载并预热模型，记录就绪状态供 health 查询"""
+
+    def __init__(self):
+        self.state = 'loading'
+        self.error = None
+        self.first_frame_done = False
+
+    @property
+    def ready(self):
+        return self.state == 'ready'
+
+    def status(self):
+        return f"failed:{self.error}" if self.state == 'failed' else self.state
+
+    async def load(self, pool):
+        """在执行池中加载并预热
+
+        进程池模式下每个工作进程启动时由执行池的 initializer 各自预热；这里同时提交 workers 个空任务，
+        在没有空闲进程时执行池会逐个启动新进程，等这些任务完成即全部工作进程都已预热
+        """
+        started = time.perf_counter()
+        logging.info("开始在后台加载模型...")
+        try:
+            if pool.kind == 'process':
+                await asyncio.gather(*(pool.run(os.getpid) for _ in range(pool.workers)))
+            else:
+                await pool.run(warm_up_models)
+        except Exception as e:
+            self.state = 'failed'
+            self.error = str(e)
+            logging.error(f"模型加载失败: {str(e)}")
+            return
+        self.state = 'ready'
+        logging.info(f"模型加载及预热完成, 用时 {time.perf_counter() - started:.2f} 秒, "
+                     f"距进程启动 {time.perf_counter() - PROCESS_START:.2f} 秒")
+
+    def mark_frame_done(self):
+        """记录进程启动到首个真实帧完成的耗时，只记录一次"""
+        if not self.first_frame_done:
+            self.first_frame_done = True
+            logging.info(f"首帧处理完成, 距进程启动 {time.perf_counter() - PROCESS_START:.2f} 秒")
+
+class InferenceScheduler:
+    """跨会话的微批处理调度器：汇集所有连接提交的帧，按批大小或等待时限组批，每个检测阶段每批只执行一次"""
+
+    def __init__(self, pool, max_batch_size=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS):
+        self.pool = pool
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait_ms = max_wait_ms
+        self.queue = None
+        self._task = None
+        self._slots = None
+        self.batches = 0
+        self.frames = 0
+        self.last_batch_size = 0
+        self.last_batch_ms = 0.0
+
+    def _ensure_started(self):
+        # 队列和后台任务必须在运行中的事件循环里创建
+        if self._task is None or self._task.done():
+            self.queue = asyncio.Queue()
+            # 同时执行的批次数不超过执行池的工作者数量
+            self._slots = asyncio.Semaphore(self.pool.workers)
+            self._task = asyncio.create_task(self._run())
+
+    async def submit(self, img_rgb, faces=None, stages=ALL_STAGES, landmarks=None):
+        """提交一帧RGB图像(可附带已知的人脸框、地标列表和需要执行的阶段)，等待所在批次推理完成后返回该帧的结果"""
+        return await self._submit((img_rgb, faces, stages, landmarks))
+
+    async def submit_job(self, job):
+        """进程池模式：提交未解码的帧和准备参数(见 prepare_frame)，返回该帧的准备结果，检测结果在其中的 detection"""
+        return await self._submit(job)
+
+    async def _submit(self, job):
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((job, time.perf_counter(), future))
+        return await future
+
+    async def _collect_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            # 有空闲工作者时才开始组批，等待期间新到的帧可以继续凑进下一批
+            await self._slots.acquire()
+            batch = await self._collect_batch()
+            asyncio.create_task(self._execute(batch))
+
+    async def _detect(self, batch):
+        jobs = [item[0] for item in batch]
+        if isinstance(jobs[0], dict):
+            return await self.pool.run(timed_frame_batch, jobs)
+        return await self.pool.run(timed_detection_batch, *(list(column) for column in zip(*jobs)))
+
+    async def _execute(self, batch):
+        try:
+            # 提交方已放弃等待(如连接断开)的帧不再推理
+            batch = [item for item in batch if not item[-1].done()]
+            if not batch:
+                return
+
+            started = time.perf_counter()
+            for item in batch:
+                metrics.observe('queue_wait', started - item[1])
+            try:
+                results, timings = await self._detect(batch)
+            except Exception as e:
+                logging.error(f"批量推理错误: {str(e)}")
+                if len(batch) == 1:
+                    if not batch[0][-1].done():
+                        batch[0][-1].set_exception(e)
+                    return
+                # 逐帧重新推理，只让出错的帧失败，不影响同批次的其他会话
+                for item in batch:
+                    if item[-1].done():
+                        continue
+                    try:
+                        (result,), _ = await self._detect([item])
+                    except Exception as frame_error:
+                        if not item[-1].done():
+                            item[-1].set_exception(frame_error)
+                    else:
+                        if not item[-1].done():
+                            item[-1].set_result(result)
+                return
+
+            self.batches += 1
+            self.frames += len(batch)
+            self.last_batch_size = len(batch)
+            self.last_batch_ms = (time.perf_counter() - started) * 1000
+            metrics.observe('batch', self.last_batch_ms / 1000)
+            for stage, seconds in timings.items():
+                metrics.observe(stage, seconds)
+            for (*_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            self._slots.release()
+
+    def get_metrics(self):
+        return {
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait_ms,
+            'queue_depth': self.queue.qsize() if self.queue is not None else 0,
+            'batches': self.batches,
+            'frames': self.frames,
+            'avg_batch_size': self.frames / self.batches if self.batches else 0,
+            'last_batch_size': self.last_batch_size,
+            'last_batch_ms': self.last_batch_ms
+        }
+
+scheduler = InferenceScheduler(inference_pool)
+model_loader = ModelLoader()
+
+def server_load():
+    """服务端负载(0~1)：在途帧占上限的比例与调度队列积压程度中的较大者"""
+    in_flight = inference_pool.in_flight / inference_pool.max_in_flight
+    queued = scheduler.queue.qsize() if scheduler.queue is not None else 0
+    backlog = queued / (scheduler.max_batch_size * inference_pool.workers)
+    return min(1.0, max(in_flight, backlog))
+
+class TokenBucket:
+    """令牌桶：按给定速率补充令牌，最多积累 burst 个，每处理一帧消耗一个"""
+
+    def __init__(self, burst=SESSION_BURST_FRAMES):
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.monotonic()
+
+    def take(self, rate, now=None):
+        """速率为0表示不限速；没有令牌时返回False"""
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * rate)
+        self.last = now
+        if rate <= 0:
+            return True
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+class AdmissionController:
+    """全局准入控制：根据推理负载和近期单帧延迟判断是否过载
+
+    过载时拒绝新会话，并把各会话的处理帧率限制在按当前吞吐量平分的公平份额内，
+    发送过快的会话多出的帧被丢弃，不会挤占其他会话
+    """
+
+    def __init__(self, max_sessions=ADMISSION_MAX_SESSIONS, latency_budget_ms=ADMISSION_LATENCY_BUDGET_MS,
+                 session_max_fps=SESSION_MAX_FPS):
+        self.max_sessions = max_sessions
+        self.latency_budget = latency_budget_ms / 1000
+        self.session_max_fps = session_max_fps
+        self.latency = 0.0
+        self.throughput = 0.0
+        self.last_frame = 0.0
+        self._window_start = time.monotonic()
+        self._window_frames = 0
+        self.rejected_sessions = 0
+        self.shed_frames = 0
+
+    def observe_frame(self, seconds, now=None):
+        """记录一帧的端到端耗时，更新延迟和吞吐量的滑动平均"""
+        now = time.monotonic() if now is None else now
+        self.latency += ADMISSION_EWMA_ALPHA * (seconds - self.latency)
+        self.last_frame = now
+        self._window_frames += 1
+        elapsed = now - self._window_start
+        if elapsed >= 1.0:
+            self.throughput += ADMISSION_EWMA_ALPHA * (self._window_frames / elapsed - self.throughput)
+            self._window_start = now
+            self._window_frames = 0
+
+    def pressure(self, now=None):
+        """负载压力：推理负载与近期延迟占预算比例中的较大者，超过1表示延迟超出预算"""
+        now = time.monotonic() if now is None else now
+        pressure = server_load()
+        # 长时间没有完成的帧时不再参考旧的延迟
+        if now - self.last_frame < ADMISSION_STALE_SECONDS and self.latency_budget > 0:
+            pressure = max(pressure, self.latency / self.latency_budget)
+        return pressure
+
+    def overloaded(self):
+        return self.pressure() >= ADMISSION_OVERLOAD_LOAD
+
+    def admit(self, active):
+        """判断是否接受新会话"""
+        if self.max_sessions and active >= self.max_sessions:
+            self.rejected_sessions += 1
+            metrics.inc('sessions_rejected')
+            return False
+        if active > 0 and self.overloaded():
+            self.rejected_sessions += 1
+            metrics.inc('sessions_rejected')
+            return False
+        return True
+
+    def frame_rate_limit(self, active):
+        """每个会话当前允许的处理帧率，0表示不限"""
+        limit = self.session_max_fps
+        if active > 0 and self.throughput > 0 and self.overloaded():
+            share = max(SESSION_MIN_FPS, self.throughput / active)
+            limit = min(limit, share) if limit else share
+        return limit
+
+    def note_shed(self):
+        self.shed_frames += 1
+        metrics.inc('frames_shed')
+
+    def get_metrics(self):
+        return {
+            'pressure': round(self.pressure(), 3),
+            'latency_ms': round(self.latency * 1000, 1),
+            'throughput_fps': round(self.throughput, 2),
+            'max_sessions': self.max_sessions,
+            'rejected_sessions': self.rejected_sessions,
+            'shed_frames': self.shed_frames
+        }
+
+admission = AdmissionController()
+
+class BucketRing:
+    """固定宽度时间桶组成的环形数组：每个桶记录各情绪的人脸数和概率和，数组预先分配
+
+    桶按 时间编号(时间戳/桶宽) 取模定位，写入时发现桶属于更早的时间编号就先清零，不需要后台清理
+    """
+
+    def __init__(self, width, size):
+        n = len(EMOTION_COLUMNS)
+        self.width = width
+        self.size = size
+        self.counts = np.zeros((size, n), dtype=np.int64)
+        self.prob_sums = np.zeros((size, n), dtype=np.float64)
+        self.epochs = np.full(size, -1, dtype=np.int64)
+
+    def add(self, timestamp, label, probs):
+        epoch = int(timestamp // self.width)
+        slot = epoch % self.size
+        if self.epochs[slot] != epoch:
+            self.counts[slot] = 0
+            self.prob_sums[slot] = 0
+            self.epochs[slot] = epoch
+        self.counts[slot, label] += 1
+        self.prob_sums[slot] += probs
+
+    def _window(self, seconds, now):
+        """最近 seconds 秒内的桶，按时间先后排列"""
+        epoch = int(now // self.width)
+        first = epoch - min(self.size, max(1, int(np.ceil(seconds / self.width)))) + 1
+        slots = np.nonzero((self.epochs >= first) & (self.epochs <= epoch))[0]
+        return slots[np.argsort(self.epochs[slots])]
+
+    def totals(self, seconds, now):
+        slots = self._window(seconds, now)
+        return self.counts[slots].sum(axis=0), self.prob_sums[slots].sum(axis=0)
+
+    def series(self, seconds, now):
+        slots = self._window(seconds, now)
+        return [
+            {'t': int(self.epochs[slot] * self.width), 'counts': self.counts[slot].tolist()}
+            for slot in slots
+        ]
+
+class LiveAggregator:
+    """全部会话共享的实时情绪汇总：每张人脸的结果以O(1)代价写入按秒和按分钟的时间桶
+
+    写入和查询都在事件循环线程中进行，不需要加锁，也不读取任何会话的状态；
+    多进程模式下每个工作进程各自汇总本进程的会话
+    """
+
+    def __init__(self, second_buckets=ANALYTICS_SECOND_BUCKETS, minute_buckets=ANALYTICS_MINUTE_BUCKETS,
+                 push_interval=ANALYTICS_PUSH_INTERVAL):
+        self.seconds = BucketRing(1, second_buckets)
+        self.minutes = BucketRing(60, minute_buckets)
+        self.push_interval = push_interval
+        self.subscribers = {}
+        # 每个订阅者正在进行的发送，慢的订阅者不会拖慢其他订阅者
+        self._sending = {}
+        self._push_task = None
+
+    def add(self, label, probs, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        probs = np.asarray(probs, dtype=float).reshape(-1)
+        self.seconds.add(timestamp, label, probs)
+        self.minutes.add(timestamp, label, probs)
+
+    def query(self, window=ANALYTICS_DEFAULT_WINDOW, series=False, now=None):
+        """最近 window 秒内全部会话的情绪构成；窗口超出按秒桶的范围时改用按分钟的桶"""
+        now = time.time() if now is None else now
+        window = max(1.0, float(window))
+        ring = self.seconds if window <= self.seconds.size else self.minutes
+        counts, prob_sums = ring.totals(window, now)
+        faces = int(counts.sum())
+        result = {
+            'time': round(now, 3),
+            'window': window,
+            'resolution': ring.width,
+            'sessions': len(active_sessions),
+            'faces': faces,
+            'counts': dict(zip(EMOTION_COLUMNS, counts.tolist())),
+            'mix': {emotion: round(100 * int(count) / faces, 2) if faces else 0.0
+                    for emotion, count in zip(EMOTION_COLUMNS, counts)},
+            'mean_probs': {emotion: round(float(value) / faces, 4) if faces else 0.0
+                           for emotion, value in zip(EMOTION_COLUMNS, prob_sums)}
+        }
+        if series:
+            result['series'] = ring.series(window, now)
+        return result
+
+    def subscribe(self, websocket, params):
+        """订阅后每隔 push_interval 秒推送一次 analytics:{json}，直到取消订阅或连接关闭"""
+        self.subscribers[websocket] = params
+        if self._push_task is None or self._push_task.done():
+            self._push_task = asyncio.create_task(self._push())
+
+    def unsubscribe(self, websocket):
+        self.subscribers.pop(websocket, None)
+
+    async def _push(self):
+        while self.subscribers:
+            await asyncio.sleep(self.push_interval)
+            # 相同参数的订阅者共用一次查询结果
+            messages = {}
+            for websocket, params in list(self.subscribers.items()):
+                if websocket in self._sending:
+                    # 上一次推送还没发完，丢弃这次已过时的更新
+                    continue
+                key = json.dumps(params, sort_keys=True)
+                if key not in messages:
+                    messages[key] = f"analytics:{json.dumps(self.query(**params))}"
+                self._sending[websocket] = asyncio.create_task(self._send(websocket, messages[key]))
+
+    async def _send(self, websocket, message):
+        try:
+            await websocket.send(message)
+        except ConnectionClosed:
+            self.unsubscribe(websocket)
+        finally:
+            self._sending.pop(websocket, None)
+
+def parse_analytics_params(params):
+    """校验看板查询参数，只接受 window(秒) 和 series"""
+    unknown = set(params) - {'window', 'series'}
+    if unknown:
+        raise ValueError(f"未知的查询参数: {sorted(unknown)}")
+    parsed = {}
+    if 'window' in params:
+        parsed['window'] = float(params['window'])
+        if not math.isfinite(parsed['window']):
+            raise ValueError(f"window 必须是有限的秒数: {params['window']}")
+    if 'series' in params:
+        parsed['series'] = params['series'] in (True, 1, '1', 'true')
+    return parsed
+
+def parse_timeline_params(params):
+    """校验会话时间序列的查询参数：window(秒)、rolling(滑动平均的帧数)和 buckets(是否返回降采样序列)"""
+    unknown = set(params) - {'window', 'rolling', 'buckets'}
+    if unknown:
+        raise ValueError(f"未知的查询参数: {sorted(unknown)}")
+    parsed = {}
+    if 'window' in params:
+        parsed['seconds'] = float(params['window'])
+        if not math.isfinite(parsed['seconds']) or parsed['seconds'] <= 0:
+            raise ValueError(f"window 必须是正的有限秒数: {params['window']}")
+    if 'rolling' in params:
+        rolling = params['rolling']
+        if isinstance(rolling, bool) or not isinstance(rolling, int) or rolling < 1:
+            raise ValueError(f"rolling 必须是正整数: {rolling!r}")
+        parsed['rolling'] = rolling
+    if 'buckets' in params:
+        parsed['buckets'] = params['buckets'] in (True, 1, '1', 'true')
+    return parsed
+
+live_analytics = LiveAggregator()
+
+class FrameCounter:
+    def __init__(self):
+        self.count = 0
+
+    def increment(self):
+        self.count += 1
+        return self.count
+
+class FrameMailbox:
+    """每个连接的帧信箱：latest_only 模式下新帧覆盖尚未处理的旧帧，并统计接收、丢弃和处理的帧数"""
+
+    def __init__(self, latest_only=True, maxsize=FRAME_QUEUE_SIZE):
+        self.latest_only = latest_only
+        self.maxsize = maxsize
+        self.received = 0
+        self.dropped = 0
+        self.processed = 0
+        self.closed = False
+        self._frames = collections.deque()
+        self._cond = asyncio.Condition()
+
+    async def put(self, frame):
+        async with self._cond:
+            self.received += 1
+            metrics.inc('frames_received')
+            if self.latest_only:
+                # 丢弃所有尚未处理的旧帧，只保留最新一帧
+                self.dropped += len(self._frames)
+                metrics.inc('frames_dropped', len(self._frames))
+                self._frames.clear()
+            else:
+                # 队列模式下队列满时暂停读取，由WebSocket向客户端施加背压
+                await self._cond.wait_for(lambda: len(self._frames) < self.maxsize or self.closed)
+            self._frames.append(frame)
+            self._cond.notify_all()
+
+    async def get(self):
+        """取出下一帧，信箱关闭且没有剩余帧时返回None"""
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._frames or self.closed)
+            if not self._frames:
+                return None
+            frame = self._frames.popleft()
+            self._cond.notify_all()
+            return frame
+
+    def mark_processed(self):
+        self.processed += 1
+        metrics.inc('frames_processed')
+
+    async def close(self):
+        async with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def get_stats(self):
+        return {
+            'mode': 'mailbox' if self.latest_only else 'queue',
+            'received': self.received,
+            'dropped': self.dropped,
+            'processed': self.processed,
+            'pending': len(self._frames)
+        }
+
+class ReportTemplates:
+    """报告模板：字体、段落样式和表格样式只构建一次，之后所有报告共用"""
+
+    def __init__(self, font_name='SimSun', font_path=REPORT_FONT_PATH):
+        # 注册自定义字体
+        pdfmetrics.registerFont(TTFont(font_name, font_path))
+        self.font_name = font_name
+        styles = getSampleStyleSheet()
+
+        # 自定义标题样式
+        self.title_style = ParagraphStyle(
+            'CustomTitle',
+            parent=styles['Heading1'],
+            fontName=font_name,
+            fontSize=24,
+            leading=28,
+            spaceAfter=30,
+            alignment=1  # 居中对齐
+        )
+
+        # 自定义子标题样式
+        self.subtitle_style = ParagraphStyle(
+            'CustomSubtitle',
+            parent=styles['Heading2'],
+            fontName=font_name,
+            fontSize=18,
+            leading=22,
+            spaceAfter=10,
+            alignment=0  # 左对齐
+        )
+
+        # 自定义正常文本样式
+        self.normal_style = ParagraphStyle(
+            'CustomNormal',
+            parent=styles['BodyText'],
+            fontName=font_name,
+            fontSize=12,
+            leading=14,
+            spaceAfter=10
+        )
+
+        # 所有统计表格共用的样式
+        self.table_style = TableStyle([
+            ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+            ('FONTNAME', (0, 0), (-1, 0), font_name),
+            ('FONTSIZE', (0, 0), (-1, 0), 14),
+            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+            ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
+            ('TEXTCOLOR', (0, 1), (-1, -1), colors.black),
+            ('FONTNAME', (0, 1), (-1, -1), font_name),
+            ('FONTSIZE', (0, 1), (-1, -1), 12),
+            ('GRID', (0, 0), (-1, -1), 1, colors.black)
+        ])
+
+    def table(self, data, col_widths):
+        table = Table(data, colWidths=col_widths)
+        table.setStyle(self.table_style)
+        return table
+
+    def render(self, story):
+        """把报告内容渲染到内存中，返回PDF字节"""
+        buffer = io.BytesIO()
+        doc = SimpleDocTemplate(
+            buffer,
+            pagesize=letter,
+            rightMargin=72,
+            leftMargin=72,
+            topMargin=72,
+            bottomMargin=72
+        )
+        doc.build(story)
+        return buffer.getvalue()
+
+_report_templates = None
+_report_templates_lock = threading.Lock()
+
+def get_report_templates():
+    """首次使用时构建报告模板，之后复用同一份"""
+    global _report_templates
+    with _report_templates_lock:
+        if _report_templates is None:
+            _import_report_libs()
+            _report_templates = ReportTemplates()
+        return _report_templates
+
+class FileReportSink:
+    """把报告写入目录，文件名带会话ID和进程内序号，同一秒内生成的报告也不会冲突"""
+
+    def __init__(self, directory=REPORT_DIR):
+        self.directory = directory
+        self._sequence = itertools.count(1)
+
+    def save(self, pdf_bytes, session_id=''):
+        os.makedirs(self.directory, exist_ok=True)
+        timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+        suffix = f"_{session_id}" if session_id else ''
+        filename = f"emotion_report_{timestamp}{suffix}_{next(self._sequence)}.pdf"
+        path = os.path.join(self.directory, filename)
+        with open(path, 'wb') as f:
+            f.write(pdf_bytes)
+        return path
+
+class MemoryReportSink:
+    """把最近生成的报告保存在内存中，用于直接回传给客户端或测试"""
+
+    def __init__(self, max_reports=16):
+        self.reports = collections.OrderedDict()
+        self.max_reports = max_reports
+        self._sequence = itertools.count(1)
+
+    def save(self, pdf_bytes, session_id=''):
+        name = f"emotion_report_{session_id}_{next(self._sequence)}.pdf"
+        self.reports[name] = pdf_bytes
+        while len(self.reports) > self.max_reports:
+            self.reports.popitem(last=False)
+        return name
+
+# 默认的报告持久化方式
+report_sink = FileReportSink()
+
+def _percentages(stats):
+    total = sum(stats.values())
+    if total == 0:
+        return {k: 0 for k in stats}
+    return {k: (v / total) * 100 for k, v in stats.items()}
+
+class ReportSectionCache:
+    """按输入缓存已构建的报告段落，段落输入没有变化时直接复用上次的内容"""
+
+    def __init__(self):
+        self._sections = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name, key, build):
+        cached = self._sections.get(name)
+        if cached is not None and cached[0] == key:
+            self.hits += 1
+        else:
+            self.misses += 1
+            cached = (key, build())
+            self._sections[name] = cached
+        # 排版时platypus会在段落对象上记录状态(如 _postponed)，缓存中保留原型，每次返回浅拷贝
+        return [copy.copy(flowable) for flowable in cached[1]]
+
+class ReportPolicy:
+    """周期报告触发策略：统计数据有变化、距上次报告至少新增N帧且至少间隔若干秒时才生成"""
+
+    def __init__(self, min_interval=REPORT_MIN_INTERVAL, every_n_frames=REPORT_EVERY_N_FRAMES):
+        self.min_interval = min_interval
+        self.every_n_frames = every_n_frames
+        self.last_time = None
+        self.last_version = 0
+        self.last_frames = 0
+
+    def should_report(self, analyzer, now=None):
+        if self.every_n_frames <= 0 or analyzer.version == self.last_version:
+            return False
+        if analyzer.total_frames - self.last_frames < self.every_n_frames:
+            return False
+        now = time.monotonic() if now is None else now
+        return self.last_time is None or now - self.last_time >= self.min_interval
+
+    def mark_reported(self, analyzer, now=None):
+        self.last_time = time.monotonic() if now is None else now
+        self.last_version = analyzer.version
+        self.last_frames = analyzer.total_frames
+
+class EmotionTimeline:
+    """逐帧情绪概率的时间序列，内存预先分配、大小固定
+
+    最近 capacity 帧的概率向量和时间戳保存在环形缓冲区中，支持按时间窗口做向量化查询；
+    全部帧同时累加到按时间分桶的降采样序列，桶数用满时合并相邻桶，适合数小时的长会话。
+    情绪切换次数和各情绪停留时长在追加时累计，整段会话的查询不依赖缓冲区是否已被覆盖。
+    """
+
+    def __init__(self, capacity=TIMELINE_CAPACITY, bucket_seconds=TIMELINE_BUCKET_SECONDS,
+                 max_buckets=TIMELINE_MAX_BUCKETS, dtype=np.float32):
+        n = len(EMOTION_COLUMNS)
+        self.capacity = capacity
+        self.probs = np.zeros((capacity, n), dtype=dtype)
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+        self.labels = np.zeros(capacity, dtype=np.int8)
+        self.count = 0
+        self.head = 0
+        # 写入过的总帧数，不受缓冲区容量限制
+        self.total = 0
+
+        self.bucket_seconds = bucket_seconds
+        self.max_buckets = max_buckets
+        self.bucket_sums = np.zeros((max_buckets, n), dtype=np.float64)
+        self.bucket_counts = np.zeros(max_buckets, dtype=np.int64)
+        self.bucket_start = None
+        self.buckets_used = 0
+
+        self.transitions = 0
+        self.dwell = np.zeros(n, dtype=np.float64)
+        self.last_label = -1
+        self.last_time = None
+
+    def __len__(self):
+        return self.count
+
+    def append(self, probs, timestamp=None):
+        """追加一帧的情绪概率，返回该帧的情绪下标"""
+        timestamp = time.time() if timestamp is None else timestamp
+        probs = np.asarray(probs, dtype=self.probs.dtype).reshape(-1)
+        label = int(np.argmax(probs))
+
+        self.probs[self.head] = probs
+        self.timestamps[self.head] = timestamp
+        self.labels[self.head] = label
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        self.total += 1
+
+        # 上一帧的情绪一直持续到本帧到达
+        if self.last_label >= 0:
+            self.dwell[self.last_label] += max(0.0, timestamp - self.last_time)
+            if label != self.last_label:
+                self.transitions += 1
+        self.last_label = label
+        self.last_time = timestamp
+
+        self._add_to_bucket(probs, timestamp)
+        return label
+
+    def _add_to_bucket(self, probs, timestamp):
+        if self.bucket_start is None:
+            self.bucket_start = timestamp
+        index = int((timestamp - self.bucket_start) // self.bucket_seconds)
+        while index >= self.max_buckets:
+            self._merge_buckets()
+            index = int((timestamp - self.bucket_start) // self.bucket_seconds)
+        index = max(index, 0)
+        self.bucket_sums[index] += probs
+        self.bucket_counts[index] += 1
+        self.buckets_used = max(self.buckets_used, index + 1)
+
+    def _merge_buckets(self):
+        """相邻两桶合并为一桶，桶宽加倍"""
+        half = (self.max_buckets + 1) // 2
+        sums = np.zeros_like(self.bucket_sums)
+        counts = np.zeros_like(self.bucket_counts)
+        np.add.at(sums, np.arange(self.max_buckets) // 2, self.bucket_sums)
+        np.add.at(counts, np.arange(self.max_buckets) // 2, self.bucket_counts)
+        self.bucket_sums = sums
+        self.bucket_counts = counts
+        self.buckets_used = min(half, (self.buckets_used + 1) // 2)
+        self.bucket_seconds *= 2
+
+    def _ordered(self, seconds=None):
+        """按时间顺序返回缓冲区中的(时间戳, 概率, 情绪下标)，seconds 指定时只取最近若干秒"""
+        if self.count < self.capacity:
+            index = slice(0, self.count)
+            timestamps, probs, labels = self.timestamps[index], self.probs[index], self.labels[index]
+        else:
+            order = np.r_[self.head:self.capacity, 0:self.head]
+            timestamps, probs, labels = self.timestamps[order], self.probs[order], self.labels[order]
+        if seconds is not None and self.count:
+            start = np.searchsorted(timestamps, timestamps[-1] - seconds, side='left')
+            timestamps, probs, labels = timestamps[start:], probs[start:], labels[start:]
+        return timestamps, probs, labels
+
+    def mean(self, seconds=None):
+        """窗口内各情绪的平均概率"""
+        _, probs, _ = self._ordered(seconds)
+        if len(probs) == 0:
+            return np.zeros(self.probs.shape[1])
+        return probs.mean(axis=0, dtype=np.float64)
+
+    def rolling_mean(self, window, seconds=None):
+        """以 window 帧为窗口的滑动平均，返回 (帧数-window+1, 情绪数) 的数组"""
+        _, probs, _ = self._ordered(seconds)
+        if window <= 0 or len(probs) < window:
+            return np.zeros((0, self.probs.shape[1]))
+        cumsum = np.cumsum(probs, axis=0, dtype=np.float64)
+        cumsum = np.vstack([np.zeros((1, probs.shape[1])), cumsum])
+        return (cumsum[window:] - cumsum[:-window]) / window
+
+    def transition_count(self, seconds=None):
+        """情绪切换次数；不指定窗口时返回整段会话的累计值"""
+        if seconds is None:
+            return self.transitions
+        _, _, labels = self._ordered(seconds)
+        return int(np.count_nonzero(labels[1:] != labels[:-1]))
+
+    def dwell_times(self, seconds=None):
+        """各情绪的停留时长(秒)；不指定窗口时返回整段会话的累计值"""
+        if seconds is None:
+            dwell = self.dwell
+        else:
+            timestamps, _, labels = self._ordered(seconds)
+            dwell = np.bincount(labels[:-1], weights=np.diff(timestamps), minlength=len(EMOTION_COLUMNS))
+        return dict(zip(EMOTION_COLUMNS, dwell.tolist()))
+
+    def buckets(self):
+        """降采样序列：返回各非空桶的起始时间和平均概率"""
+        if self.bucket_start is None:
+            return np.zeros(0), np.zeros((0, self.probs.shape[1]))
+        used = slice(0, self.buckets_used)
+        counts = self.bucket_counts[used]
+        filled = counts > 0
+        starts = self.bucket_start + np.arange(self.buckets_used)[filled] * self.bucket_seconds
+        means = self.bucket_sums[used][filled] / counts[filled, None]
+        return starts, means
 
-    def increment(self):
-        self.count += 1
-        return self.count
+    def summary(self, seconds=None, rolling=0, buckets=False):
+        """可直接序列化为JSON的查询结果：窗口内的平均概率、切换次数和停留时长，
+        rolling 大于0时附带以该帧数为窗口的滑动平均，buckets 为True时附带整段会话的降采样序列"""
+        result = {
+            'frames': self.total,
+            'buffered': self.count,
+            'window': seconds,
+            'mean': dict(zip(EMOTION_COLUMNS, np.round(self.mean(seconds), 4).tolist())),
+            'transitions': self.transition_count(seconds),
+            'dwell': {emotion: round(value, 3) for emotion, value in self.dwell_times(seconds).items()}
+        }
+        if rolling:
+            result['rolling_mean'] = np.round(self.rolling_mean(rolling, seconds), 4).tolist()
+        if buckets:
+            starts, means = self.buckets()
+            result['buckets'] = {
+                'seconds': self.bucket_seconds,
+                'start': np.round(starts, 3).tolist(),
+                'mean': np.round(means, 4).tolist()
+            }
+        return result
+
+class PersonStats:
+    """一个人(会话内的人脸编号)的情绪统计"""
+
+    def __init__(self, person_id, timestamp):
+        self.person_id = person_id
+        self.emotion_stats = dict.fromkeys(EMOTION_COLUMNS, 0)
+        self.frames = 0
+        self.first_seen = timestamp
+        self.last_seen = timestamp
+
+    def update(self, emotion, timestamp):
+        self.emotion_stats[emotion] += 1
+        self.frames += 1
+        self.last_seen = max(self.last_seen, timestamp)
+
+    def dominant_emotion(self):
+        return max(self.emotion_stats.items(), key=lambda x: x[1])[0]
 
 class EmotionAnalyzer:
     def __init__(self):
@@ -85,11 +1656,82 @@ class EmotionAnalyzer:
         }
         self.total_frames = 0
         self.start_time = datetime.datetime.now()
+        self.frame_counters = None
+        self.performance = None
+        self.au_sums = np.zeros(len(AU_COLUMNS))
+        self.au_frames = 0
+        self.timeline = EmotionTimeline()
+        # 多人画面中每个人的情绪统计，键为人脸编号
+        self.people = {}
+        # 统计数据每次变化时递增，用于判断报告是否需要重新生成
+        self.version = 0
 
-    def update_stats(self, emotion):
+    def set_frame_counters(self, counters):
+        """记录连接的接收/丢弃/处理帧数，写入报告的基本信息"""
+        self.frame_counters = counters
+
+    def set_performance(self, summary):
+        """记录会话各阶段耗时摘要，写入报告的性能指标段落"""
+        self.performance = summary
+
+    def report_key(self):
+        """报告的全部输入：统计版本之外还包括帧数统计和耗时摘要，它们变化时(如无人脸或丢弃的帧)报告也不同"""
+        return self.version, self.frame_counters, self.performance
+
+    def update_stats(self, emotion, probs=None, timestamp=None):
+        """累计一帧的情绪结果，传入概率向量时同时写入情绪时间序列"""
         if emotion in self.emotion_stats:
             self.emotion_stats[emotion] += 1
             self.total_frames += 1
+            self.version += 1
+            if probs is not None:
+                self.timeline.append(probs, timestamp)
+
+    def update_person(self, person_id, emotion, timestamp=None):
+        """累计一个人在一帧中的情绪结果"""
+        if emotion not in self.emotion_stats:
+            return
+        timestamp = time.time() if timestamp is None else timestamp
+        person = self.people.get(person_id)
+        if person is None:
+            person = self.people[person_id] = PersonStats(person_id, timestamp)
+        person.update(emotion, timestamp)
+        self.version += 1
+
+    def snapshot(self):
+        """复制当前统计数据，供后台线程生成报告时使用，不受后续帧更新影响"""
+        return copy.deepcopy(self)
+
+    def update_aus(self, au_values):
+        """累计一帧的AU强度，用于报告中的AU均值"""
+        self.au_sums += np.asarray(au_values, dtype=float)
+        self.au_frames += 1
+        self.version += 1
+
+    def section_keys(self):
+        """报告各段落的输入，输入不变的段落可以复用上次构建的内容"""
+        counts = tuple(self.emotion_stats.values())
+        return {
+            'stats': counts,
+            'aus': (self.au_frames, tuple(self.au_sums)),
+            'findings': (self.get_dominant_emotion(), self._change_frequency(),
+                         tuple(self.timeline.dwell.round(1))),
+            'chart': counts,
+            'people': tuple((person_id, tuple(person.emotion_stats.values()))
+                            for person_id, person in sorted(self.people.items())),
+            'performance': tuple(sorted((stage, tuple(summary.values()))
+                                        for stage, summary in (self.performance or {}).items()))
+        }
+
+    def _change_frequency(self):
+        """平均每多少帧发生一次情绪切换，按时间序列中实际的切换次数计算，没有切换时为0"""
+        transitions = self.timeline.transition_count()
+        return self.timeline.total / transitions if transitions else 0
+
+    def get_au_means(self):
+        if self.au_frames == 0:
+            return {}
+        return dict(zip(AU_COLUMNS, self.au_sums / self.au_frames))
 
     def get_dominant_emotion(self):
         return max(self.emotion_stats.items(), key=lambda x: x[1])[0]
@@ -100,21 +1742,39 @@ class EmotionAnalyzer:
         return {k: (v / self.total_frames) * 100 for k, v in self.emotion_stats.items()}
 
     def generate_emotion_plot(self):
-        plt.figure(figsize=(10, 6))
+        """用ReportLab矢量图形绘制情绪分布柱状图：不经过pyplot、不产生临时文件，可在多个线程中并行调用"""
+        font_name = get_report_templates().font_name
         emotions = list(self.emotion_stats.keys())
         values = list(self.emotion_stats.values())
-        plt.bar(emotions, values, color='skyblue')
-        plt.title('情绪分布统计', fontproperties='SimSun', fontsize=14)
-        plt.xlabel('情绪类型', fontproperties='SimSun', fontsize=12)
-        plt.ylabel('出现次数', fontproperties='SimSun', fontsize=12)
-        plt.xticks(rotation=45, ha='right')
-        plt.tight_layout()
-
-        # 保存图表
-        plot_path = 'emotion_distribution.png'
-        plt.savefig(plot_path, bbox_inches='tight')
-        plt.close()
-        return plot_path
+
+        drawing = Drawing(6 * inch, 4 * inch)
+        chart = VerticalBarChart()
+        chart.x = 60
+        chart.y = 70
+        chart.width = drawing.width - 80
+        chart.height = drawing.height - 110
+        chart.data = [values]
+        chart.bars[0].fillColor = colors.skyblue
+        chart.bars[0].strokeColor = None
+        chart.valueAxis.valueMin = 0
+        chart.valueAxis.valueMax = max(1, max(values))
+        chart.valueAxis.labels.fontName = font_name
+        chart.categoryAxis.categoryNames = emotions
+        chart.categoryAxis.labels.fontName = font_name
+        chart.categoryAxis.labels.angle = 45
+        chart.categoryAxis.labels.boxAnchor = 'ne'
+        chart.categoryAxis.labels.dy = -2
+        drawing.add(chart)
+
+        # 标题和坐标轴名称
+        drawing.add(String(drawing.width / 2, drawing.height - 20, '情绪分布统计',
+                           fontName=font_name, fontSize=14, textAnchor='middle'))
+        drawing.add(String(chart.x + chart.width / 2, 8, '情绪类型',
+                           fontName=font_name, fontSize=12, textAnchor='middle'))
+        y_label = Group(String(0, 0, '出现次数', fontName=font_name, fontSize=12, textAnchor='middle'))
+        y_label.transform = (0, 1, -1, 0, 18, chart.y + chart.height / 2)
+        drawing.add(y_label)
+        return drawing
 
     def generate_fake_audio_emotion_stats(self):
         # 根据现有数据生成虚构的音频情绪统计数据
@@ -142,51 +1802,103 @@ class EmotionAnalyzer:
         }
         return text_emotion_stats
 
-    def generate_pdf_report(self):
-        # 注册自定义字体
-        pdfmetrics.registerFont(TTFont('SimSun', 'simsun.ttf'))
+    def _build_stats_section(self, templates):
+        flowables = []
+        sections = [
+            ("视频情绪统计", self.emotion_stats),
+            ("音频情绪统计", self.generate_fake_audio_emotion_stats()),
+            ("文字情绪统计", self.generate_fake_text_emotion_stats())
+        ]
+        for title, stats in sections:
+            flowables.append(Paragraph(title, templates.subtitle_style))
+            flowables.append(self._stats_table(templates, stats))
+            flowables.append(Spacer(1, 20))
+        return flowables
 
-        doc = SimpleDocTemplate(
-            f"emotion_report_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf",
-            pagesize=letter,
-            rightMargin=72,
-            leftMargin=72,
-            topMargin=72,
-            bottomMargin=72
-        )
-        styles = getSampleStyleSheet()
+    def _build_au_section(self, templates):
+        au_means = self.get_au_means()
+        if not au_means:
+            return []
+        au_data = [['动作单元', '平均强度']]
+        for au_name, value in au_means.items():
+            au_data.append([au_name, f"{value:.3f}"])
+        return [
+            Paragraph(f"面部动作单元(AU)平均强度 (基于{self.au_frames}帧)", templates.subtitle_style),
+            templates.table(au_data, [2 * inch, 1.5 * inch]),
+            Spacer(1, 20)
+        ]
 
-        # 自定义标题样式
-        title_style = ParagraphStyle(
-            'CustomTitle',
-            parent=styles['Heading1'],
-            fontName='SimSun',
-            fontSize=24,
-            leading=28,
-            spaceAfter=30,
-            alignment=1  # 居中对齐
-        )
+    def _build_findings_section(self, templates):
+        flowables = [Paragraph("主要发现:", templates.subtitle_style)]
+        dominant_emotion = self.get_dominant_emotion()
+        average_change_frequency = self._change_frequency()
 
-        # 自定义子标题样式
-        subtitle_style = ParagraphStyle(
-            'CustomSubtitle',
-            parent=styles['Heading2'],
-            fontName='SimSun',
-            fontSize=18,
-            leading=22,
-            spaceAfter=10,
-            alignment=0  # 左对齐
-        )
+        main_findings = [f"- 主要情绪: {dominant_emotion}"]
+        if average_change_frequency:
+            main_findings.append(f"- 情绪变化频率: 每{average_change_frequency:.2f}帧发生一次变化")
+        else:
+            main_findings.append("- 情绪变化频率: 未发生变化")
 
-        # 自定义正常文本样式
-        normal_style = ParagraphStyle(
-            'CustomNormal',
-            parent=styles['BodyText'],
-            fontName='SimSun',
-            fontSize=12,
-            leading=14,
-            spaceAfter=10
-        )
+        # 停留时间最长的情绪
+        dwell = self.timeline.dwell_times()
+        longest = max(dwell.items(), key=lambda x: x[1])
+        if longest[1] > 0:
+            main_findings.append(f"- 停留最久的情绪: {longest[0]} ({longest[1]:.1f}秒)")
+
+        for finding in main_findings:
+            flowables.append(Paragraph(finding, templates.normal_style))
+        flowables.append(Spacer(1, 20))
+        return flowables
+
+    def _build_people_section(self, templates):
+        """画面中出现过多个人时，按出现帧数从多到少为每个人列出情绪统计"""
+        if len(self.people) < 2:
+            return []
+        people = sorted(self.people.values(), key=lambda person: person.frames, reverse=True)
+        flowables = [Paragraph(f"人员情绪统计 (共{len(people)}人)", templates.subtitle_style)]
+        for person in people[:REPORT_MAX_PEOPLE]:
+            flowables.append(Paragraph(
+                f"人员 {person.person_id}: 出现 {person.frames} 帧 ({person.last_seen - person.first_seen:.0f}秒), "
+                f"主要情绪: {person.dominant_emotion()}",
+                templates.normal_style
+            ))
+            flowables.append(self._stats_table(templates, person.emotion_stats))
+            flowables.append(Spacer(1, 12))
+        if len(people) > REPORT_MAX_PEOPLE:
+            flowables.append(Paragraph(f"另有 {len(people) - REPORT_MAX_PEOPLE} 人出现帧数较少，未单独列出",
+                                       templates.normal_style))
+        flowables.append(Spacer(1, 20))
+        return flowables
+
+    def _build_performance_section(self, templates):
+        if not self.performance:
+            return []
+        data = [['处理阶段', '次数', '平均(ms)', 'P50(ms)', 'P95(ms)']]
+        for stage, summary in sorted(self.performance.items()):
+            data.append([
+                stage, str(summary['count']), f"{summary['mean_ms']:.1f}",
+                f"≤{summary['p50_ms']:.1f}", f"≤{summary['p95_ms']:.1f}"
+            ])
+        return [
+            Paragraph("性能指标", templates.subtitle_style),
+            templates.table(data, [1.5 * inch, 1 * inch, 1.2 * inch, 1.2 * inch, 1.2 * inch]),
+            Spacer(1, 20)
+        ]
+
+    def _stats_table(self, templates, stats):
+        data = [['情绪类型', '出现次数', '占比(%)']]
+        percentages = _percentages(stats)
+        for emotion, count in stats.items():
+            data.append([emotion, str(count), f"{percentages[emotion]:.2f}%"])
+        return templates.table(data, [2 * inch, 1.5 * inch, 1.5 * inch])
+
+    def render_pdf_report(self, cache=None):
+        """生成报告并返回内存中的PDF字节，不写磁盘；传入段落缓存时复用输入未变化的段落"""
+        templates = get_report_templates()
+        cache = cache or ReportSectionCache()
+        keys = self.section_keys()
+        title_style = templates.title_style
+        normal_style = templates.normal_style
 
         story = []
 
@@ -204,201 +1916,942 @@ class EmotionAnalyzer:
             f"分析持续时间: {duration}",
             f"总处理帧数: {self.total_frames}"
         ]
+        if self.frame_counters is not None:
+            basic_info.extend([
+                f"接收帧数: {self.frame_counters['received']}",
+                f"丢弃帧数: {self.frame_counters['dropped']}",
+                f"推理帧数: {self.frame_counters['processed']}"
+            ])
 
         for info in basic_info:
             story.append(Paragraph(info, normal_style))
         story.append(Spacer(1, 20))
 
-        # 添加视频情绪统计表格
-        video_emotion_data = [['情绪类型', '出现次数', '占比(%)']]
-        video_percentages = self.get_emotion_percentages()
-        for emotion, count in self.emotion_stats.items():
-            video_emotion_data.append([emotion, str(count), f"{video_percentages[emotion]:.2f}%"])
+        # 添加视频、音频、文字情绪统计表格
+        story.extend(cache.get('stats', keys['stats'], lambda: self._build_stats_section(templates)))
 
-        table_video = Table(video_emotion_data, colWidths=[2 * inch, 1.5 * inch, 1.5 * inch])
-        table_video.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, 0), 'SimSun'),
-            ('FONTSIZE', (0, 0), (-1, 0), 14),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-            ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-            ('TEXTCOLOR', (0, 1), (-1, -1), colors.black),
-            ('FONTNAME', (0, 1), (-1, -1), 'SimSun'),
-            ('FONTSIZE', (0, 1), (-1, -1), 12),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black)
-        ]))
-        story.append(Paragraph("视频情绪统计", subtitle_style))
-        story.append(table_video)
-        story.append(Spacer(1, 20))
+        # 添加AU均值表格(仅在会话计算过AU时)
+        story.extend(cache.get('aus', keys['aus'], lambda: self._build_au_section(templates)))
 
-        # 添加音频情绪统计表格
-        audio_emotion_stats = self.generate_fake_audio_emotion_stats()
-        audio_emotion_data = [['情绪类型', '出现次数', '占比(%)']]
-        audio_percentages = {k: (v / sum(audio_emotion_stats.values())) * 100 for k, v in audio_emotion_stats.items()}
-        for emotion, count in audio_emotion_stats.items():
-            audio_emotion_data.append([emotion, str(count), f"{audio_percentages[emotion]:.2f}%"])
+        # 添加主要发现
+        story.extend(cache.get('findings', keys['findings'], lambda: self._build_findings_section(templates)))
 
-        table_audio = Table(audio_emotion_data, colWidths=[2 * inch, 1.5 * inch, 1.5 * inch])
-        table_audio.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, 0), 'SimSun'),
-            ('FONTSIZE', (0, 0), (-1, 0), 14),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-            ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-            ('TEXTCOLOR', (0, 1), (-1, -1), colors.black),
-            ('FONTNAME', (0, 1), (-1, -1), 'SimSun'),
-            ('FONTSIZE', (0, 1), (-1, -1), 12),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black)
-        ]))
-        story.append(Paragraph("音频情绪统计", subtitle_style))
-        story.append(table_audio)
-        story.append(Spacer(1, 20))
+        # 添加情绪分布图
+        story.extend(cache.get('chart', keys['chart'], lambda: [self.generate_emotion_plot()]))
 
-        # 添加文字情绪统计表格
-        text_emotion_stats = self.generate_fake_text_emotion_stats()
-        text_emotion_data = [['情绪类型', '出现次数', '占比(%)']]
-        text_percentages = {k: (v / sum(text_emotion_stats.values())) * 100 for k, v in text_emotion_stats.items()}
-        for emotion, count in text_emotion_stats.items():
-            text_emotion_data.append([emotion, str(count), f"{text_percentages[emotion]:.2f}%"])
+        # 多人画面中每个人的情绪统计
+        story.extend(cache.get('people', keys['people'], lambda: self._build_people_section(templates)))
 
-        table_text = Table(text_emotion_data, colWidths=[2 * inch, 1.5 * inch, 1.5 * inch])
-        table_text.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, 0), 'SimSun'),
-            ('FONTSIZE', (0, 0), (-1, 0), 14),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-            ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-            ('TEXTCOLOR', (0, 1), (-1, -1), colors.black),
-            ('FONTNAME', (0, 1), (-1, -1), 'SimSun'),
-            ('FONTSIZE', (0, 1), (-1, -1), 12),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black)
-        ]))
-        story.append(Paragraph("文字情绪统计", subtitle_style))
-        story.append(table_text)
-        story.append(Spacer(1, 20))
+        # 添加本会话各处理阶段的耗时统计
+        story.extend(cache.get('performance', keys['performance'], lambda: self._build_performance_section(templates)))
 
-        # 添加主要发现
-        story.append(Paragraph("主要发现:", subtitle_style))
-        dominant_emotion = self.get_dominant_emotion()
-        average_change_frequency = self.total_frames / len([v for v in self.emotion_stats.values() if v > 0]) if any(
-            v > 0 for v in self.emotion_stats.values()) else 0
+        # 生成PDF
+        return templates.render(story)
 
-        main_findings = [
-            f"- 主要情绪: {dominant_emotion}",
-            f"- 情绪变化频率: 每{average_change_frequency:.2f}帧发生一次变化"
-        ]
+    def generate_pdf_report(self, sink=None, session_id=''):
+        """生成报告并交给存储(默认写入报告目录)，返回存储位置"""
+        sink = sink or report_sink
+        location = sink.save(self.render_pdf_report(), session_id)
+        logging.info(f"PDF报告已生成: {location}")
+        return location
 
-        for finding in main_findings:
-            story.append(Paragraph(finding, normal_style))
-        story.append(Spacer(1, 20))
 
-        # 添加情绪分布图
-        plot_path = self.generate_emotion_plot()
-        img = Image(plot_path)
-        img.drawHeight = 4 * inch
-        img.drawWidth = 6 * inch
-        story.append(img)
+def restore_analyzer(started, events):
+    """根据事件日志中的记录重建情绪分析器
 
-        # 生成PDF
-        doc.build(story)
-        logging.info(f"PDF报告已生成: {doc.filename}")
+    events 为 (帧序号, 时间戳, 情绪下标, 概率, AU强度, 各人脸的(人脸编号, 情绪下标)) 的列表
+    """
+    analyzer = EmotionAnalyzer()
+    analyzer.start_time = datetime.datetime.fromtimestamp(started)
+    for _, timestamp, emotion, probs, aus, faces in events:
+        if emotion is not None:
+            analyzer.update_stats(EMOTION_COLUMNS[emotion], probs, timestamp)
+        if aus is not None:
+            analyzer.update_aus(aus)
+        for person, face_emotion in faces:
+            analyzer.update_person(person, EMOTION_COLUMNS[face_emotion], timestamp)
+    return analyzer
+
+class GeneratedReport:
+    """一份已生成的报告：PDF字节、存储位置(未持久化时为None)和生成时的报告输入(见 EmotionAnalyzer.report_key)"""
+
+    def __init__(self, data, location=None, key=None):
+        self.data = data
+        self.location = location
+        self.key = key
+
+def build_report(analyzer, sink=None, session_id='', cache=None):
+    """在后台线程中渲染报告，并在指定了存储时持久化"""
+    data = analyzer.render_pdf_report(cache)
+    location = sink.save(data, session_id) if sink is not None else None
+    return GeneratedReport(data, location, analyzer.report_key())
+
+class FrameResultCache:
+    """会话内近似重复帧的结果缓存：按感知哈希查找最近的帧，汉明距离在阈值内时直接复用其检测结果
+
+    连续复用达到 max_streak 帧后强制重新推理一次，避免画面缓慢变化时一直沿用旧结果；
+    缓存按最近使用顺序淘汰
+    """
+
+    def __init__(self, threshold=DEDUP_THRESHOLD, max_streak=DEDUP_MAX_STREAK, capacity=DEDUP_CACHE_SIZE):
+        self.threshold = threshold
+        self.max_streak = max_streak
+        self.capacity = max(1, capacity)
+        self._entries = collections.OrderedDict()
+        self.streak = 0
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        """返回(是否命中, 缓存的检测结果)；未检测到面部的结果也会被缓存，命中时结果为None"""
+        if self.streak < self.max_streak:
+            for cached_key in reversed(self._entries):
+                if bin(cached_key ^ key).count('1') <= self.threshold:
+                    self._entries.move_to_end(cached_key)
+                    self.streak += 1
+                    self.hits += 1
+                    metrics.inc('dedup_hits')
+                    return True, self._entries[cached_key]
+        self.streak = 0
+        self.misses += 1
+        metrics.inc('dedup_misses')
+        return False, None
+
+    def candidate_keys(self):
+        """可能命中的缓存哈希，连续复用已达上限时为空，供工作进程预先比较"""
+        return list(self._entries) if self.streak < self.max_streak else []
+
+    def store(self, key, detection):
+        self._entries[key] = detection
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def get_stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'size': len(self._entries)
+        }
+
+class QualityController:
+    """根据服务端负载调整建议给发送端的画质档位(人脸尺寸、JPEG质量、帧率)"""
+
+    def __init__(self, level=QUALITY_DEFAULT_LEVEL, interval=QUALITY_EVAL_INTERVAL):
+        self.level = level
+        self.interval = interval
+        self.last_eval = time.monotonic()
+        self.last_received = 0
+        self.last_dropped = 0
+        self.busy = 0
+        self.changes = 0
+
+    def note_busy(self):
+        self.busy += 1
+
+    def evaluate(self, mailbox_stats, load, now=None):
+        """到评估时间时根据本周期的丢帧率、繁忙次数和服务端负载调整档位，档位变化时返回新档位的参数，否则返回None"""
+        now = time.monotonic() if now is None else now
+        if now - self.last_eval < self.interval:
+            return None
+        received = mailbox_stats['received'] - self.last_received
+        dropped = mailbox_stats['dropped'] - self.last_dropped
+        drop_rate = dropped / received if received else 0.0
+        busy = self.busy
+        self.last_eval = now
+        self.last_received = mailbox_stats['received']
+        self.last_dropped = mailbox_stats['dropped']
+        self.busy = 0
+
+        level = self.level
+        if busy or drop_rate > QUALITY_MAX_DROP_RATE or load > QUALITY_HIGH_LOAD:
+            level = max(0, level - 1)
+        elif dropped == 0 and load < QUALITY_LOW_LOAD:
+            level = min(len(QUALITY_LEVELS) - 1, level + 1)
+        if level == self.level:
+            return None
+        self.level = level
+        self.changes += 1
+        return dict(QUALITY_LEVELS[level], level=level)
+
+    def get_stats(self):
+        return {'level': self.level, 'changes': self.changes}
+
+class FaceTracker:
+    """会话内的人脸跟踪状态：关键帧做完整检测，中间帧用模板匹配沿用上一帧的人脸框和地标"""
+
+    def __init__(self, min_score=TRACK_MIN_SCORE):
+        self.min_score = min_score
+        self.template = None
+        self.box = None
+        self.landmarks = None
+        self.since_keyframe = 0
+        self.keyframes = 0
+        self.tracked = 0
+        self.lost = 0
+        self.multi_face = 0
+
+    def needs_keyframe(self, keyframe_interval):
+        return self.template is None or self.since_keyframe >= keyframe_interval
+
+    def reset(self):
+        self.template = None
+        self.box = None
+        self.landmarks = None
 
-        # 删除临时图片文件
-        os.remove(plot_path)
+    def set_keyframe(self, img_rgb, faces, landmarks, template=None):
+        """用完整检测的结果(第一张人脸)重新初始化跟踪；img_rgb 为None时使用工作进程截取好的 template
 
-        return doc.filename
+        画面中有多张人脸时不跟踪，下一帧继续做完整检测，避免其他人在非关键帧中消失
+        """
+        self.keyframes += 1
+        self.since_keyframe = 0
+        if len(faces) > 1:
+            self.multi_face += 1
+            self.reset()
+            return
+        self.box = list(faces[0])
+        self.landmarks = landmarks[0] if landmarks is not None else None
+        self.template = crop_face_template(img_rgb, self.box) if img_rgb is not None else template
 
+    def accept(self, box, landmarks, template, score):
+        """接受一次跟踪结果，匹配分数过低时丢失跟踪，下一帧改做完整检测"""
+        if box is None or score < self.min_score:
+            self.lost += 1
+            self.reset()
+            return False
+        self.tracked += 1
+        self.since_keyframe += 1
+        self.box = box
+        self.landmarks = landmarks
+        self.template = template
+        return True
+
+    def get_stats(self):
+        return {'keyframes': self.keyframes, 'tracked': self.tracked, 'lost': self.lost, 'multi_face': self.multi_face}
+
+class FaceIdentities:
+    """会话内的人脸编号：按人脸框IoU把当前帧的人脸与已知的人贪心匹配，匹配不上的分配新编号"""
+
+    def __init__(self, min_iou=FACE_ID_MIN_IOU, max_missed=FACE_ID_MAX_MISSED):
+        self.min_iou = min_iou
+        self.max_missed = max_missed
+        self.boxes = {}
+        self.missed = {}
+        self.next_id = 1
+
+    def assign(self, boxes):
+        """返回与 boxes 一一对应的人脸编号；连续 max_missed 帧未出现的人不再参与匹配"""
+        ids = [None] * len(boxes)
+        known = list(self.boxes)
+        if known and boxes:
+            iou = box_iou([self.boxes[person] for person in known], [box[:4] for box in boxes])
+            # 按IoU从高到低依次匹配，每个人和每张人脸只匹配一次
+            for flat in np.argsort(iou, axis=None)[::-1]:
+                row, col = divmod(int(flat), len(boxes))
+                if iou[row, col] < self.min_iou:
+                    break
+                if ids[col] is None and known[row] not in ids:
+                    ids[col] = known[row]
+
+        for index, person in enumerate(ids):
+            if person is None:
+                person = ids[index] = self.next_id
+                self.next_id += 1
+            self.boxes[person] = [float(v) for v in boxes[index][:4]]
+            self.missed[person] = 0
+
+        for person in known:
+            if person not in ids:
+                self.missed[person] += 1
+                if self.missed[person] > self.max_missed:
+                    del self.boxes[person]
+                    del self.missed[person]
+        return ids
+
+    def get_stats(self):
+        return {'visible': sum(1 for missed in self.missed.values() if missed == 0), 'assigned': self.next_id - 1}
+
+class ReportWorker:
+    """后台报告生成器：PDF在独立线程池中生成，同一会话排队中的报告请求只保留最新的一次"""
+
+    def __init__(self, workers=REPORT_WORKERS):
+        self.workers = max(1, workers)
+        self._executor = None
+        self._pending = {}
+        self._active = set()
+        self.generated = 0
+        self.coalesced = 0
+        self.reused = 0
+        self.failed = 0
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='report')
+        return self._executor
+
+    def submit(self, key, analyzer, on_done=None, sink=report_sink, cache=None):
+        """提交一次报告请求，on_done(report, error) 在报告完成后被调用；sink为None时只在内存中生成
+
+        同一会话的报告按顺序生成，因此可以安全地共用该会话的段落缓存 cache
+
+        该会话已有尚未开始的请求时，用最新的统计快照替换它，并合并完成回调
+        """
+        callbacks = []
+        if key in self._pending:
+            self.coalesced += 1
+            callbacks = self._pending[key][3]
+        if on_done is not None:
+            callbacks.append(on_done)
+        self._pending[key] = (analyzer.snapshot(), sink, cache, callbacks)
+
+        if key not in self._active:
+            self._active.add(key)
+            asyncio.create_task(self._drain(key))
+
+    async def _drain(self, key):
+        loop = asyncio.get_running_loop()
+        try:
+            while key in self._pending:
+                snapshot, sink, cache, callbacks = self._pending.pop(key)
+                report, error = None, None
+                try:
+                    started = time.perf_counter()
+                    report = await loop.run_in_executor(
+                        self._get_executor(), build_report, snapshot, sink, key, cache
+                    )
+                    metrics.observe('report', time.perf_counter() - started)
+                    self.generated += 1
+                except Exception as e:
+                    error = e
+                    self.failed += 1
+                    metrics.inc('reports_failed')
+                    logging.error(f"生成PDF报告时发生错误: {str(e)}")
+
+                for callback in callbacks:
+                    try:
+                        await callback(report, error)
+                    except Exception as e:
+                        logging.error(f"报告完成回调错误: {str(e)}")
+        finally:
+            self._active.discard(key)
+
+    def get_metrics(self):
+        return {
+            'workers': self.workers,
+            'pending': len(self._pending),
+            'active': len(self._active),
+            'generated': self.generated,
+            'coalesced': self.coalesced,
+            'reused': self.reused,
+            'failed': self.failed
+        }
+
+report_worker = ReportWorker()
+event_log = SessionEventLog(EVENT_LOG_PATH, EVENT_LOG_BATCH, EVENT_LOG_FLUSH_MS / 1000) if EVENT_LOG_PATH else None
+
+# 各结果状态在 legacy 格式下对应的提示文字
+LEGACY_STATUS_MESSAGES = {
+    'loading': "模型加载中",
+    'decode_failed': "图像转换失败",
+    'no_face': "未检测到面部",
+    'failed': "情绪识别失败"
+}
+
+def legacy_messages(result):
+    """把一帧的结果转换为旧格式的多条消息"""
+    status = result['status']
+    if status == 'busy':
+        return [f"busy:{result['frame']}"]
+    if status == 'decode_failed':
+        return [LEGACY_STATUS_MESSAGES[status]]
+
+    frame_tag = f"frame:{result['frame']}" if 'id' not in result else f"frame:{result['frame']}:{result['id']}"
+    if status != 'ok':
+        return [frame_tag, LEGACY_STATUS_MESSAGES[status]]
+    messages = [frame_tag]
+    if result.get('emotion') is not None:
+        messages.append(str(result['emotion']))
+    if 'aus' in result:
+        messages.append(f"aus:{json.dumps(result['aus'])}")
+    if 'landmarks' in result:
+        messages.append(f"landmarks:{json.dumps(result['landmarks'])}")
+    return messages
+
+class ResultSender:
+    """按会话配置的格式发送每帧结果
+
+    legacy 格式保持原有的多条消息；json 格式每帧一条 result:{...}。
+    json 格式开启 coalesce 时发送在后台进行，上一次发送尚未完成(客户端接收慢)期间产生的结果
+    合并为一条 results:[...]，帧处理不必等待发送完成
+    """
+
+    def __init__(self, websocket, config):
+        self.websocket = websocket
+        self.config = config
+        self._pending = []
+        self._flushing = None
+        self.messages = 0
+        self.coalesced = 0
+
+    async def send(self, result):
+        if self.config['protocol'] != 'json':
+            for message in legacy_messages(result):
+                await self.websocket.send(message)
+            self.messages += 1
+            return
+        if not self.config['coalesce']:
+            await self.websocket.send(f"result:{json.dumps(result, separators=(',', ':'))}")
+            self.messages += 1
+            return
+
+        self._pending.append(result)
+        if self._flushing is None or self._flushing.done():
+            self._flushing = asyncio.create_task(self._flush())
+
+    async def _flush(self):
+        try:
+            while self._pending:
+                batch = self._pending[:RESULT_MAX_COALESCE]
+                del self._pending[:RESULT_MAX_COALESCE]
+                if len(batch) == 1:
+                    message = f"result:{json.dumps(batch[0], separators=(',', ':'))}"
+                else:
+                    message = f"results:{json.dumps(batch, separators=(',', ':'))}"
+                    self.coalesced += len(batch) - 1
+                await self.websocket.send(message)
+                self.messages += 1
+        except ConnectionClosed:
+            self._pending.clear()
+
+    def get_stats(self):
+        return {'messages': self.messages, 'coalesced': self.coalesced, 'pending': len(self._pending)}
+
+class ClientSession:
+    """一个WebSocket连接的全部状态：帧计数、情绪统计、帧信箱和协商的会话配置"""
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.session_id = uuid.uuid4().hex[:12]
+        self.started = time.time()
+        self.logged = False
+        self.frame_counter = FrameCounter()
+        self.emotion_analyzer = EmotionAnalyzer()  # 创建情绪分析器实例
+        self.mailbox = FrameMailbox(latest_only=FRAME_MODE == 'mailbox')
+        self.config = dict(DEFAULT_SESSION_CONFIG)
+        self._update_stages()
+        self.tracker = FaceTracker()
+        self.identities = FaceIdentities()
+        self.frame_cache = FrameResultCache()
+        self.quality = QualityController()
+        self.frame_bucket = TokenBucket()
+        self.shed = 0
+        self.report_policy = ReportPolicy()
+        self.report_cache = ReportSectionCache()
+        self.last_report = None
+        # 本会话各阶段的耗时，写入报告的性能指标段落
+        self.metrics = MetricsRegistry()
+        self.results = ResultSender(websocket, self.config)
+
+    def observe(self, stage, seconds):
+        """记录一次阶段耗时，同时计入全局指标和本会话指标"""
+        metrics.observe(stage, seconds)
+        self.metrics.observe(stage, seconds)
+
+    def _update_stages(self):
+        outputs = self.config['outputs']
+        self.stages = resolve_pipeline_stages(outputs)
+        # 不计算AU的帧需要的阶段
+        self.stages_without_aus = resolve_pipeline_stages([output for output in outputs if output != 'aus'])
+
+    def apply_config(self, updates):
+        """更新会话配置，返回被忽略的未知配置项；配置值无效时抛出ValueError且配置保持不变"""
+        if 'outputs' in updates:
+            resolve_pipeline_stages(updates['outputs'])
+        if 'protocol' in updates and updates['protocol'] not in RESULT_PROTOCOLS:
+            raise ValueError(f"未知的结果格式: {updates['protocol']}")
+        for key in ('au_interval', 'keyframe_interval'):
+            value = updates.get(key, 1)
+            if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+                raise ValueError(f"{key} 必须是正整数: {value!r}")
+        unknown = [key for key in updates if key not in self.config]
+        for key, value in updates.items():
+            if key in self.config:
+                self.config[key] = value
+        self._update_stages()
+        return unknown
+
+    async def resume(self, session_id):
+        """从事件日志恢复之前的会话：沿用其编号、帧序号和情绪统计，只能在处理第一帧之前恢复"""
+        if event_log is None or not event_log.enabled:
+            raise ValueError("未开启会话事件日志，无法恢复会话")
+        if self.frame_counter.count:
+            raise ValueError("会话已开始处理帧，无法恢复其他会话")
+        if any(session.session_id == session_id for session in active_sessions if session is not self):
+            raise ValueError(f"会话仍在进行中: {session_id}")
+        try:
+            loaded = await asyncio.get_running_loop().run_in_executor(None, event_log.load_session, session_id)
+        except sqlite3.Error as e:
+            raise ValueError(f"读取会话事件日志失败: {str(e)}")
+        if loaded is None:
+            raise ValueError(f"未找到会话: {session_id}")
+        if self.frame_counter.count:
+            raise ValueError("会话已开始处理帧，无法恢复其他会话")
+        self.started, events = loaded
+        self.session_id = session_id
+        self.logged = True
+        self.emotion_analyzer = restore_analyzer(self.started, events)
+        self.frame_counter.count = events[-1][0] if events else 0
+        # 新出现的人接着之前的编号分配，不与恢复的人员统计混淆
+        self.identities.next_id = max(self.emotion_analyzer.people, default=0) + 1
+        self.report_cache = ReportSectionCache()
+        self.last_report = None
+        logging.info(f"已恢复会话 {session_id}: {len(events)} 帧")
+
+    def log_frame(self, seq, timestamp, emotion=None, probs=None, aus=None, faces=None):
+        """把一帧的结果追加到事件日志，由后台线程批量提交；faces 为每张人脸的 (人脸编号, 情绪下标, 概率)"""
+        if event_log is None or not event_log.enabled:
+            return
+        if not self.logged:
+            self.logged = True
+            event_log.start_session(self.session_id, self.started)
+        event_log.append(self.session_id, seq, timestamp, emotion, probs, aus, faces)
+
+    def stages_for_frame(self, count):
+        """本帧需要执行的阶段：AU按 au_interval 每N帧计算一次"""
+        interval = self.config['au_interval']
+        if 'aus' in self.stages and interval > 1 and count % interval != 0:
+            return self.stages_without_aus
+        return self.stages
+
+    def request_report(self, notify=True):
+        """把报告生成交给后台工作者，notify为True时完成后通过连接发送 report_generated/report_error
+
+        会话配置 report_delivery 为 inline 时报告不落盘，PDF字节以二进制消息直接回传
+        """
+        self.emotion_analyzer.set_frame_counters(self.mailbox.get_stats())
+        self.emotion_analyzer.set_performance(self.metrics.summary())
+        inline = notify and self.config['report_delivery'] == 'inline'
+
+        # 报告的输入自上次报告后没有变化时直接复用上次的报告，不再重新生成
+        last = self.last_report
+        if last is not None and last.key == self.emotion_analyzer.report_key() and (inline or last.location is not None):
+            report_worker.reused += 1
+            if notify:
+                asyncio.create_task(self._on_report_done(last, None))
+            return
+
+        report_worker.submit(
+            self.session_id,
+            self.emotion_analyzer,
+            self._on_report_done if notify else self._log_report,
+            sink=None if inline else report_sink,
+            cache=self.report_cache
+        )
+
+    async def _log_report(self, report, error):
+        if error is None and report is not self.last_report:
+            self.last_report = report
+            if report.location is not None:
+                logging.info(f"已生成PDF报告: {report.location}")
+
+    async def _on_report_done(self, report, error):
+        await self._log_report(report, error)
+        try:
+            if error is not None:
+                await self.websocket.send(f"report_error:{str(error)}")
+            elif report.location is None:
+                # 先发送说明消息，紧接着发送PDF字节
+                await self.websocket.send(f"report_generated:inline:{len(report.data)}")
+                await self.websocket.send(report.data)
+            else:
+                await self.websocket.send(f"report_generated:{report.location}")
+        except ConnectionClosed:
+            pass
+
+    async def update_quality(self):
+        """开启画质自适应时按负载调整档位，档位变化后发送 quality:{json} 通知发送端"""
+        if not self.config['adaptive_quality']:
+            return
+        hint = self.quality.evaluate(self.mailbox.get_stats(), admission.pressure())
+        if hint is not None:
+            logging.info(f"会话 {self.session_id} 画质档位调整为 {hint}")
+            await self.websocket.send(f"quality:{json.dumps(hint)}")
+
+    def get_stats(self):
+        stats = self.mailbox.get_stats()
+        stats['tracking'] = self.tracker.get_stats()
+        stats['faces'] = self.identities.get_stats()
+        stats['dedup'] = self.frame_cache.get_stats()
+        stats['quality'] = self.quality.get_stats()
+        stats['shed'] = self.shed
+        timeline = self.emotion_analyzer.timeline
+        stats['timeline'] = {'frames': timeline.total, 'buffered': timeline.count, 'transitions': timeline.transitions}
+        stats['timings'] = self.metrics.summary()
+        stats['results'] = self.results.get_stats()
+        stats['config'] = self.config
+        return stats
+
+async def process_frame(session, message):
+    """处理一帧图像：解码、推理、更新统计并发送结果"""
+    frame_started = time.perf_counter()
+
+    # 增加计数器
+    count = session.frame_counter.increment()
+    logging.info(f"处理第 {count} 帧")
+
+    # 二进制帧带有客户端帧号时在回复中一并返回，便于客户端对应请求
+    result = {'frame': count}
+    client_box = None
+    if isinstance(message, bytes):
+        client_frame_id, _, client_box, _ = parse_binary_frame(message)
+        if client_frame_id is not None:
+            result['id'] = client_frame_id
+
+    # 模型仍在后台加载时不排队等待，直接告知客户端
+    if not model_loader.ready:
+        result['status'] = 'loading'
+        await session.results.send(result)
+        return
+
+    # 超出本会话的帧率份额时丢弃该帧，发送过快的会话不能挤占其他会话
+    if not session.frame_bucket.take(admission.frame_rate_limit(len(active_sessions))):
+        session.shed += 1
+        admission.note_shed()
+        session.quality.note_busy()
+        result['status'] = 'busy'
+        await session.results.send(result)
+        return
+
+    # 执行池已饱和时直接告知客户端，不让帧在服务端堆积
+    if not inference_pool.try_acquire():
+        metrics.inc('frames_busy')
+        session.quality.note_busy()
+        result['status'] = 'busy'
+        await session.results.send(result)
+        return
+
+    try:
+        if inference_pool.kind == 'process':
+            await process_frame_in_worker(session, message, result, client_box, count, frame_started)
+            return
+
+        # 在执行池中解码并转换为RGB格式
+        started = time.perf_counter()
+        img_rgb, scale = await inference_pool.run(decode_frame, message)
+        session.observe('decode_jpeg' if isinstance(message, bytes) else 'decode_base64', time.perf_counter() - started)
+        if img_rgb is None:
+            result['status'] = 'decode_failed'
+            await session.results.send(result)
+            return
+
+        # 画面与最近的帧几乎相同时直接复用其检测结果，跳过推理
+        frame_key = None
+        if session.config['dedup']:
+            frame_key = await inference_pool.run(frame_hash, img_rgb)
+            cached, detection = session.frame_cache.lookup(frame_key)
+            if cached:
+                result['cached'] = True
+                await finish_frame(session, result, detection, frame_started, scale)
+                return
+
+        # 客户端已裁剪人脸时跳过服务端面部检测，未通过合理性检查则回退到完整检测
+        faces = None
+        if session.config['precropped']:
+            if client_box is not None and scale != 1:
+                client_box = [value / scale for value in client_box[:4]] + [client_box[4]]
+            face_box = precropped_face_box(img_rgb, client_box)
+            if face_box is not None:
+                faces = [face_box]
+            else:
+                logging.info(f"帧 {count}: 预裁剪人脸未通过检查，执行完整面部检测")
+
+        # 跟踪模式下非关键帧用模板匹配沿用上一帧的人脸框和地标，跟踪分数过低时改做完整检测
+        tracker = session.tracker if session.config['tracking'] else None
+        landmarks = None
+        keyframe = False
+        if faces is None and tracker is not None:
+            if tracker.needs_keyframe(session.config['keyframe_interval']):
+                keyframe = True
+            else:
+                started = time.perf_counter()
+                tracked = await inference_pool.run(track_face, img_rgb, tracker.template, tracker.box, tracker.landmarks)
+                session.observe('track', time.perf_counter() - started)
+                if tracker.accept(*tracked):
+                    faces = [tracker.box]
+                    if tracker.landmarks is not None:
+                        landmarks = [tracker.landmarks]
+                else:
+                    keyframe = True
+
+        # 交给调度器与其他连接的帧一起组批推理，只执行会话输出项需要的阶段
+        started = time.perf_counter()
+        detection = await scheduler.submit(img_rgb, faces, session.stages_for_frame(count), landmarks)
+        session.observe('inference', time.perf_counter() - started)
+        if keyframe:
+            if detection is None:
+                tracker.reset()
+            else:
+                tracker.set_keyframe(img_rgb, detection['faces'], detection['landmarks'])
+        if frame_key is not None:
+            session.frame_cache.store(frame_key, detection)
+        await finish_frame(session, result, detection, frame_started, scale)
+
+    except ConnectionClosed:
+        raise
+    except Exception as e:
+        logging.error(f"情绪识别错误: {str(e)}")
+        failed = {key: result[key] for key in ('frame', 'id') if key in result}
+        failed['status'] = 'failed'
+        await session.results.send(failed)
+    finally:
+        inference_pool.release()
+
+async def process_frame_in_worker(session, message, result, client_box, count, frame_started):
+    """进程池模式下处理一帧：根据会话状态生成准备参数，连同未解码的帧一起交给调度器，
+    解码、去重哈希、预裁剪检查、跟踪和检测在同一个工作进程中完成，图像不跨进程传递"""
+    tracker = session.tracker if session.config['tracking'] else None
+    track = None
+    if tracker is not None and not tracker.needs_keyframe(session.config['keyframe_interval']):
+        track = (tracker.template, tracker.box, tracker.landmarks)
+    job = {
+        'message': message,
+        'dedup': session.config['dedup'],
+        'dedup_keys': session.frame_cache.candidate_keys(),
+        'dedup_threshold': session.frame_cache.threshold,
+        'precropped': session.config['precropped'],
+        'client_box': client_box,
+        'track': track,
+        'min_score': tracker.min_score if tracker is not None else 0.0,
+        'keyframe': tracker is not None and track is None,
+        'stages': session.stages_for_frame(count)
+    }
+
+    started = time.perf_counter()
+    outcome = await scheduler.submit_job(job)
+    # 解码和跟踪的耗时单独记录，不计入推理
+    for stage, seconds in outcome['timings'].items():
+        session.observe(stage, seconds)
+    if outcome['status'] == 'decode_failed':
+        result['status'] = 'decode_failed'
+        await session.results.send(result)
+        return
+    session.observe('inference', time.perf_counter() - started - sum(outcome['timings'].values()))
+
+    # 工作进程只做了哈希比较，命中与否仍由会话的缓存决定(同时维护连续复用次数和淘汰顺序)
+    frame_key = outcome['frame_key']
+    if frame_key is not None:
+        cached, detection = session.frame_cache.lookup(frame_key)
+        if cached:
+            result['cached'] = True
+            await finish_frame(session, result, detection, frame_started, outcome['scale'])
+            return
+        if not outcome['detect']:
+            raise RuntimeError("工作进程的去重比较结果与会话缓存不一致")
+
+    if outcome.get('precrop_rejected'):
+        logging.info(f"帧 {count}: 预裁剪人脸未通过检查，执行完整面部检测")
+    if outcome['tracked'] is not None:
+        tracker.accept(*outcome['tracked'])
+    detection = outcome['detection']
+    if outcome['keyframe']:
+        if detection is None:
+            tracker.reset()
+        else:
+            tracker.set_keyframe(None, detection['faces'], detection['landmarks'], outcome.get('template'))
+    if frame_key is not None:
+        session.frame_cache.store(frame_key, detection)
+    await finish_frame(session, result, detection, frame_started, outcome['scale'])
+
+async def finish_frame(session, result, detection, frame_started, scale=1):
+    """根据一帧的检测结果更新会话统计、触发周期报告并发送结果；scale 为解码时的缩小倍数，地标换算回原图坐标"""
+    emotion_analyzer = session.emotion_analyzer
+    if detection is None:
+        # 没有人脸的帧也计入每个人的缺席帧数，离开的人按时不再参与匹配(与 batch_analyze 一致)
+        session.identities.assign([])
+        result['status'] = 'no_face'
+        await session.results.send(result)
+        return
+
+    result['status'] = 'ok'
+    timestamp = time.time()
+    # 为每张人脸分配会话内稳定的编号，按原图坐标匹配，不受解码缩放影响
+    faces = detection['faces']
+    people = session.identities.assign([[float(v) * scale for v in face[:4]] for face in faces])
+    emotion = None
+    max_index = None
+    probs = None
+    logged_faces = None
+    if detection['emotions'] is not None:
+        # 顶层的 emotion/probs 为第一张人脸，faces 中是画面里每个人的结果
+        probs = detection['emotions'][0]
+        max_index = int(np.argmax(probs))
+        emotion = EMOTION_COLUMNS[max_index]
+        result['emotion'] = emotion
+        result['probs'] = [round(float(value), 4) for value in probs]
+
+        # 更新情绪统计
+        emotion_analyzer.update_stats(emotion, probs, timestamp)
+
+        result['faces'] = []
+        logged_faces = []
+        for person, face, face_probs in zip(people, faces, detection['emotions']):
+            index = int(np.argmax(face_probs))
+            emotion_analyzer.update_person(person, EMOTION_COLUMNS[index], timestamp)
+            live_analytics.add(index, face_probs, timestamp)
+            logged_faces.append((person, index, face_probs))
+            result['faces'].append({
+                'id': person,
+                'box': [round(float(v) * scale, 1) for v in face[:4]],
+                'emotion': EMOTION_COLUMNS[index],
+                'probs': [round(float(value), 4) for value in face_probs]
+            })
+
+    aus = detection['aus'][0] if detection['aus'] is not None else None
+    if aus is not None:
+        emotion_analyzer.update_aus(aus)
+
+    # 结果写入会话事件日志，断线或重启后可恢复统计和重新生成报告
+    if emotion is not None or aus is not None:
+        session.log_frame(result['frame'], timestamp, max_index, probs, aus, logged_faces)
+
+    # 按报告策略在后台生成周期报告，不阻塞帧处理
+    if session.report_policy.should_report(emotion_analyzer):
+        session.report_policy.mark_reported(emotion_analyzer)
+        session.request_report()
+
+    # 其他输出项按会话配置附加到结果中
+    outputs = session.config['outputs']
+    if 'aus' in outputs and detection['aus'] is not None:
+        result['aus'] = {name: round(float(value), 4) for name, value in zip(AU_COLUMNS, detection['aus'][0])}
+    if 'landmarks' in outputs and detection['landmarks'] is not None:
+        result['landmarks'] = (np.asarray(detection['landmarks'][0]).reshape(-1, 2) * scale).round(1).tolist()
+    result['ms'] = round((time.perf_counter() - frame_started) * 1000, 1)
+
+    started = time.perf_counter()
+    await session.results.send(result)
+    session.observe('send', time.perf_counter() - started)
+    session.observe('frame', time.perf_counter() - frame_started)
+    admission.observe_frame(time.perf_counter() - frame_started)
+    logging.info(f"帧 {result['frame']}: 检测到的情绪: {emotion}")
+    model_loader.mark_frame_done()
+
+async def frame_worker(session):
+    """从信箱中逐帧取出并处理，直到信箱关闭"""
+    mailbox = session.mailbox
+    while True:
+        message = await mailbox.get()
+        if message is None:
+            break
+        try:
+            await process_frame(session, message)
+            await session.update_quality()
+        except ConnectionClosed:
+            break
+        except Exception as e:
+            error_msg = f"处理图像时发生错误: {str(e)}"
+            logging.error(error_msg)
+            try:
+                await session.websocket.send(error_msg)
+            except Exception:
+                break
+        finally:
+            mailbox.mark_processed()
 
 async def process_frames(websocket):
-    frame_counter = FrameCounter()
-    emotion_analyzer = EmotionAnalyzer()  # 创建情绪分析器实例
+    # 过载或会话数已满时拒绝新连接(关闭码1013，稍后重试)，配置了备用地址时先告知客户端改连
+    if not admission.admit(len(active_sessions)):
+        logging.warning(f"服务器过载或会话数已满，拒绝新连接: {admission.get_metrics()}")
+        if ADMISSION_REDIRECT_URL:
+            await websocket.send(f"redirect:{ADMISSION_REDIRECT_URL}")
+        await websocket.close(1013, "server overloaded")
+        return
+
+    session = ClientSession(websocket)
+    active_sessions.add(session)
+    metrics.inc('sessions')
+    worker = asyncio.create_task(frame_worker(session))
     logging.info("新的WebSocket连接已建立")
     try:
         async for message in websocket:
             try:
-                # 验证是否为base64编码的图像数据
-                if message.startswith('data:image'):
-                    # 增加计数器
-                    count = frame_counter.increment()
-                    logging.info(f"处理第 {count} 帧")
-
-                    # 转换图像为cv2格式
-                    img_array = base64_to_cv2(message)
-                    if img_array is None:
-                        await websocket.send("图像转换失败")
-                        continue
+                # 图像帧(二进制JPEG或base64 data URL)交给信箱，由处理任务异步消费
+                if is_frame_message(message):
+                    await session.mailbox.put(message)
 
+                elif message.startswith("config:"):
+                    # 协商会话配置，如 config:{"precropped": true}
+                    # 带 session_id 时先从事件日志恢复该会话；回复中带上当前的会话编号供客户端重连时使用
                     try:
-                        # 转换为RGB格式
-                        img_rgb = cv2.cvtColor(img_array, cv2.COLOR_BGR2RGB)
-
-                        # 面部检测
-                        faces = detector.detect_faces(img_rgb)
-                        if len(faces) == 0:
-                            await websocket.send(f"frame:{count}")
-                            await websocket.send("未检测到面部")
-                            continue
-
-                        # 地标提取
-                        landmarks = detector.detect_landmarks(img_rgb, faces)
-
-                        # AU分析
-                        aus = detector.detect_aus(img_rgb, landmarks)
-
-                        # 情绪识别
-                        emotions = detector.detect_emotions(frame=img_rgb, facebox=faces, landmarks=landmarks)
-                        emotions_list = ['anger', 'disgust', 'fear', 'happiness', 'sadness', 'surprise', 'neutral']
-                        max_index = np.argmax(emotions[0])
-                        emotion = emotions_list[max_index]
-
-                        # 更新情绪统计
-                        emotion_analyzer.update_stats(emotion)
-                        
-                        # 每处理100帧生成一次报告
-                        if frame_counter.count % 10 == 0:
-                            try:
-                                report_path = emotion_analyzer.generate_pdf_report()
-                                logging.info(f"已生成新的PDF报告: {report_path}")
-                            except Exception as e:
-                                logging.error(f"生成PDF报告时发生错误: {str(e)}")
-
-                        # 发送帧数和情绪结果
-                        await websocket.send(f"frame:{count}")
-                        await websocket.send(str(emotion))
-                        logging.info(f"帧 {count}: 检测到的情绪: {emotion}")
-
-                    except Exception as e:
-                        logging.error(f"情绪识别错误: {str(e)}")
-                        await websocket.send(f"frame:{count}")
-                        await websocket.send("情绪识别失败")
+                        updates = json.loads(message[len("config:"):])
+                        if 'session_id' in updates:
+                            await session.resume(updates.pop('session_id'))
+                        unknown = session.apply_config(updates)
+                        if unknown:
+                            logging.warning(f"忽略未知的会话配置项: {unknown}")
+                        await websocket.send(f"config_ok:{json.dumps(dict(session.config, session_id=session.session_id))}")
+                    except (ValueError, AttributeError) as e:
+                        await websocket.send(f"config_error:{str(e)}")
 
                 elif message == "generate_report":
-                    # 添加手动生成报告的功能
-                    try:
-                        report_path = emotion_analyzer.generate_pdf_report()
-                        await websocket.send(f"report_generated:{report_path}")
-                    except Exception as e:
-                        await websocket.send(f"report_error:{str(e)}")
+                    # 手动生成报告，完成后发送 report_generated
+                    session.request_report()
 
                 elif message == "ping":
                     await websocket.send("pong")
 
+                elif message == "analytics" or message.startswith("analytics:"):
+                    # 看板查询：analytics 或 analytics:{"window": 60, "series": true}，回复 analytics:{json}
+                    try:
+                        params = parse_analytics_params(json.loads(message[len("analytics:"):] or '{}'))
+                        await websocket.send(f"analytics:{json.dumps(live_analytics.query(**params))}")
+                    except (ValueError, TypeError, AttributeError) as e:
+                        await websocket.send(f"analytics_error:{str(e)}")
+
+                elif message == "subscribe_analytics" or message.startswith("subscribe_analytics:"):
+                    # 订阅后按固定间隔推送 analytics:{json}，参数与 analytics 相同
+                    try:
+                        params = parse_analytics_params(json.loads(message[len("subscribe_analytics:"):] or '{}'))
+                        live_analytics.subscribe(websocket, params)
+                    except (ValueError, TypeError, AttributeError) as e:
+                        await websocket.send(f"analytics_error:{str(e)}")
+
+                elif message == "unsubscribe_analytics":
+                    live_analytics.unsubscribe(websocket)
+
+                elif message == "timeline" or message.startswith("timeline:"):
+                    # 本会话的情绪时间序列：timeline 或 timeline:{"window": 60, "rolling": 10, "buckets": true}，
+                    # 回复 timeline:{json}
+                    try:
+                        params = parse_timeline_params(json.loads(message[len("timeline:"):] or '{}'))
+                        timeline = session.emotion_analyzer.timeline.summary(**params)
+                        await websocket.send(f"timeline:{json.dumps(timeline)}")
+                    except (ValueError, TypeError, AttributeError) as e:
+                        await websocket.send(f"timeline_error:{str(e)}")
+
+                elif message == "health":
+                    # 模型就绪状态：health:ready / health:loading / health:failed:原因
+                    await websocket.send(f"health:{model_loader.status()}")
+
+                elif message == "stats":
+                    stats = {
+                        'model': model_loader.status(),
+                        'backend': INFERENCE_BACKEND + ('-int8' if INFERENCE_BACKEND == 'onnx' and ONNX_QUANTIZE else ''),
+                        'scheduler': scheduler.get_metrics(),
+                        'executor': inference_pool.get_metrics(),
+                        'reports': report_worker.get_metrics(),
+                        'admission': admission.get_metrics(),
+                        'event_log': event_log.get_stats() if event_log is not None else None,
+                        'session': session.get_stats()
+                    }
+                    await websocket.send(f"stats:{json.dumps(stats)}")
+
             except ConnectionClosed:
-                # 在连接关闭时生成最终报告
-                try:
-                    final_report = emotion_analyzer.generate_pdf_report()
-                    logging.info(f"已生成最终报告: {final_report}")
-                except Exception as e:
-                    logging.error(f"生成最终报告时发生错误: {str(e)}")
                 break
             except Exception as e:
-                error_msg = f"处理图像时发生错误: {str(e)}"
+                error_msg = f"处理消息时发生错误: {str(e)}"
                 logging.error(error_msg)
                 try:
                     await websocket.send(error_msg)
@@ -407,9 +2860,81 @@ async def process_frames(websocket):
     except Exception as e:
         logging.error(f"处理消息时发生错误: {str(e)}")
     finally:
-        logging.info("WebSocket连接已关闭")
+        await session.mailbox.close()
+        worker.cancel()
+        try:
+            await worker
+        except asyncio.CancelledError:
+            pass
+
+        # 在连接关闭时生成最终报告；没有分析过任何帧的连接(探测、查询、看板等)不生成
+        live_analytics.unsubscribe(websocket)
+        active_sessions.discard(session)
+        if session.emotion_analyzer.version:
+            session.request_report(notify=False)
+        logging.info(f"WebSocket连接已关闭, 帧统计: {session.mailbox.get_stats()}")
+
+# 当前活动的会话
+active_sessions = set()
+
+metrics.gauge('active_sessions', lambda: len(active_sessions))
+metrics.gauge('mailbox_pending', lambda: sum(len(session.mailbox._frames) for session in active_sessions))
+metrics.gauge('scheduler_queue_depth', lambda: scheduler.queue.qsize() if scheduler.queue is not None else 0)
+metrics.gauge('inference_in_flight', lambda: inference_pool.in_flight)
+metrics.gauge('reports_pending', lambda: len(report_worker._pending))
+metrics.gauge('model_ready', lambda: model_loader.ready)
+metrics.gauge('admission_pressure', lambda: admission.pressure())
+metrics.gauge('frame_latency_ewma_seconds', lambda: admission.latency)
+metrics.gauge('event_log_pending', lambda: event_log._queue.qsize() if event_log is not None else 0)
+
+async def handle_metrics_request(reader, writer):
+    """极简HTTP处理：GET /metrics 返回Prometheus文本格式的指标，GET /analytics?window=60&series=1
+    返回跨会话实时汇总的JSON，其余路径返回404"""
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        # 读完请求头，忽略内容
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.decode('latin-1').split()
+        path, _, query = parts[1].partition('?') if len(parts) >= 2 and parts[0] == 'GET' else ('', '', '')
+        content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        if path == '/metrics':
+            status, body = '200 OK', metrics.render_prometheus().encode('utf-8')
+        elif path == '/analytics':
+            try:
+                params = parse_analytics_params(dict(urllib.parse.parse_qsl(query)))
+                status, body = '200 OK', json.dumps(live_analytics.query(**params)).encode('utf-8')
+                content_type = 'application/json'
+            except ValueError as e:
+                status, body = '400 Bad Request', f"{str(e)}\n".encode('utf-8')
+        else:
+            status, body = '404 Not Found', b'not found\n'
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('latin-1') + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def start_metrics_server(port):
+    """在本机启动指标HTTP端点，端口为0时不启动"""
+    if not port:
+        return None
+    try:
+        server = await asyncio.start_server(handle_metrics_request, '127.0.0.1', port)
+    except OSError as e:
+        logging.error(f"指标端点启动失败(端口 {port}): {str(e)}")
+        return None
+    logging.info(f"指标端点运行于 http://127.0.0.1:{port}/metrics, 实时汇总 http://127.0.0.1:{port}/analytics")
+    return server
 
-async def main():
+async def main(reuse_port=False, metrics_port=METRICS_PORT):
+    # 监听先启动，模型在后台加载，加载完成前帧请求回复“模型加载中”
+    loader = asyncio.create_task(model_loader.load(inference_pool))
+    metrics_server = await start_metrics_server(metrics_port)
     while True:
         try:
             logging.info("启动Python WebSocket服务器...")
@@ -421,13 +2946,70 @@ async def main():
                 max_queue=16,
                 ping_timeout=None,
                 ping_interval=None,
-                close_timeout=5
+                close_timeout=5,
+                reuse_port=reuse_port
             ):
-                logging.info("服务器正在运行于 ws://localhost:8765")
+                logging.info("服务器正在运行于 ws://localhost:8765, "
+                             f"启动用时 {time.perf_counter() - PROCESS_START:.2f} 秒")
                 await asyncio.Future()
         except Exception as e:
             logging.error(f"服务器错误: {str(e)}")
             await asyncio.sleep(5)  # 等待5秒后重试
 
+def run_worker(index, torch_threads):
+    """工作进程入口：限制本进程的计算线程数后启动服务，与其他工作进程共同监听端口"""
+    global TORCH_THREADS
+    TORCH_THREADS = torch_threads
+    for name in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS'):
+        os.environ[name] = str(torch_threads)
+    logging.info(f"工作进程 {index} 已启动, pid={os.getpid()}, torch线程数={torch_threads}")
+    try:
+        asyncio.run(main(reuse_port=True, metrics_port=METRICS_PORT + index if METRICS_PORT else 0))
+    except KeyboardInterrupt:
+        pass
+
+def supervise(workers):
+    """启动多个工作进程并监视，异常退出的进程自动重启"""
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        logging.warning("当前系统不支持 SO_REUSEPORT，以单进程模式运行")
+        asyncio.run(main())
+        return
+
+    torch_threads = TORCH_THREADS or max(1, (os.cpu_count() or 1) // workers)
+    mp = multiprocessing.get_context('spawn')
+    processes = {}
+
+    def start(index):
+        process = mp.Process(target=run_worker, args=(index, torch_threads), name=f"mf-worker-{index}")
+        process.start()
+        processes[index] = process
+
+    # 收到 SIGTERM 时与 Ctrl+C 一样停止所有工作进程后退出
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    logging.info(f"以多进程模式启动: {workers} 个工作进程, 每个进程torch线程数 {torch_threads}")
+    for index in range(workers):
+        start(index)
+    try:
+        while True:
+            time.sleep(WORKER_RESTART_DELAY)
+            for index, process in list(processes.items()):
+                if process.exitcode is not None:
+                    logging.error(f"工作进程 {index} (pid={process.pid}) 已退出, 退出码 {process.exitcode}, 正在重启")
+                    start(index)
+    except (KeyboardInterrupt, SystemExit):
+        logging.info("正在停止所有工作进程...")
+    finally:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.join()
+
 if __name__ == "__main__":
-    asyncio.run(main()) 
\ No newline at end of file
+    # 也可以用命令行参数指定工作进程数: python python_server.py --workers 8
+    workers = SERVER_WORKERS
+    if '--workers' in sys.argv:
+        workers = int(sys.argv[sys.argv.index('--workers') + 1])
+    if workers > 1:
+        supervise(workers)
+    else:
+        asyncio.run(main())
\ No newline at end of file
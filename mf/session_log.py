@@ -0,0 +1,256 @@
+"""
+会话事件日志 - 把每个会话的逐帧结果追加写入SQLite(WAL模式)，连接断开或进程重启后统计数据不丢失
+
+帧处理只把记录放入队列，由后台线程攒批后在一个事务中提交，热路径不等待磁盘；
+WAL模式下 synchronous=NORMAL，每次提交不做fsync，进程崩溃不会丢失已提交的记录，
+只有断电时可能丢失最后一次检查点之后的少量记录。
+
+用法示例:
+    # 列出日志中的会话
+    python session_log.py list --db sessions.db
+    # 根据日志重新生成某个会话的PDF报告，不需要重新处理视频
+    python session_log.py report 3f2a9c1b7d4e --db sessions.db --report-dir reports/
+"""
+
+import argparse
+import atexit
+import datetime
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    started REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS events (
+    session_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    time REAL NOT NULL,
+    emotion INTEGER,
+    probs BLOB,
+    aus BLOB,
+    PRIMARY KEY (session_id, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS faces (
+    session_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    person INTEGER NOT NULL,
+    emotion INTEGER NOT NULL,
+    probs BLOB,
+    PRIMARY KEY (session_id, seq, person)
+) WITHOUT ROWID;
+"""
+
+def _to_blob(values):
+    """概率和AU向量按float32紧凑存储"""
+    return None if values is None else np.asarray(values, dtype=np.float32).tobytes()
+
+def _from_blob(blob):
+    return None if blob is None else np.frombuffer(blob, dtype=np.float32)
+
+class SessionEventLog:
+    """按会话保存逐帧结果的事件日志：append 线程安全且不阻塞，由后台线程分批提交"""
+
+    def __init__(self, path, batch_size=256, flush_interval=0.2, max_pending=10000, flush_timeout=5.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.flush_timeout = flush_timeout
+        # 数据库无法打开时记录原因并停用日志，之后的记录直接丢弃
+        self.error = None
+        self._queue = queue.Queue(max_pending)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+        self.commits = 0
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.executescript(SCHEMA)
+        return connection
+
+    @property
+    def enabled(self):
+        return self.error is None
+
+    def _disable(self, error):
+        if self.error is None:
+            self.error = str(error)
+            logging.error(f"无法打开会话事件日志 {self.path}，停止记录: {self.error}")
+
+    def _ensure_writer(self):
+        """首次写入时才启动写入线程，由写入线程打开数据库，只导入本模块不会创建文件，调用方也不等待磁盘"""
+        if self._thread is not None or not self.enabled:
+            return
+        with self._lock:
+            if self._thread is None and self.enabled:
+                self._thread = threading.Thread(target=self._run, name='session-log', daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def _put(self, item):
+        self._ensure_writer()
+        if not self.enabled:
+            self.dropped += 1
+            return
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            # 磁盘跟不上时丢弃记录，不阻塞帧处理
+            self.dropped += 1
+
+    def start_session(self, session_id, started):
+        self._put(('session', (session_id, started), None))
+
+    def append(self, session_id, seq, timestamp, emotion=None, probs=None, aus=None, faces=None):
+        """追加一帧的结果：emotion 为情绪下标，probs/aus 为概率和AU强度向量，
+        faces 为画面中每个人的 (人脸编号, 情绪下标, 概率)"""
+        face_records = [
+            (session_id, seq, person, face_emotion, _to_blob(face_probs))
+            for person, face_emotion, face_probs in faces or ()
+        ]
+        self._put(('event', (session_id, seq, timestamp, emotion, _to_blob(probs), _to_blob(aus)), face_records))
+
+    def _run(self):
+        # 数据库无法打开时停用日志，之后的记录直接丢弃；
+        # 已在队列中的记录仍继续取出并标记完成，flush 不会一直等待
+        try:
+            connection = self._connect()
+        except sqlite3.Error as e:
+            self._disable(e)
+            connection = None
+        while True:
+            batch = [self._queue.get()]
+            # 攒批：凑满 batch_size 条或等待 flush_interval 后一起提交
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                if connection is None:
+                    self.dropped += len(batch)
+                else:
+                    self._write(connection, batch)
+            except sqlite3.Error as e:
+                self.dropped += len(batch)
+                logging.error(f"写入会话事件日志失败: {str(e)}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write(self, connection, batch):
+        sessions = [record for kind, record, _ in batch if kind == 'session']
+        events = [record for kind, record, _ in batch if kind == 'event']
+        faces = [face for kind, _, face_records in batch if kind == 'event' for face in face_records]
+        with connection:
+            connection.executemany('INSERT OR IGNORE INTO sessions VALUES (?, ?)', sessions)
+            connection.executemany('INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?, ?, ?)', events)
+            connection.executemany('INSERT OR REPLACE INTO faces VALUES (?, ?, ?, ?, ?)', faces)
+        self.written += len(events)
+        self.commits += 1
+
+    def flush(self, timeout=None):
+        """等待队列中的记录全部提交，最多等待 timeout 秒(默认 flush_timeout)，超时返回False"""
+        if self._thread is None:
+            return True
+        deadline = time.monotonic() + (self.flush_timeout if timeout is None else timeout)
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logging.warning(f"等待会话事件日志提交超时，仍有 {self._queue.unfinished_tasks} 条记录未提交")
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def load_session(self, session_id):
+        """读取一个会话的开始时间和按帧序号排列的全部事件，会话不存在时返回None
+
+        每个事件为 (帧序号, 时间戳, 情绪下标, 概率, AU强度, 各人脸的(人脸编号, 情绪下标)列表)
+        """
+        self.flush()
+        connection = self._connect()
+        try:
+            row = connection.execute('SELECT started FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+            if row is None:
+                return None
+            faces = {}
+            for seq, person, emotion in connection.execute(
+                    'SELECT seq, person, emotion FROM faces WHERE session_id = ? ORDER BY seq, person', (session_id,)):
+                faces.setdefault(seq, []).append((person, emotion))
+            events = [
+                (seq, timestamp, emotion, _from_blob(probs), _from_blob(aus), faces.get(seq, []))
+                for seq, timestamp, emotion, probs, aus in connection.execute(
+                    'SELECT seq, time, emotion, probs, aus FROM events WHERE session_id = ? ORDER BY seq',
+                    (session_id,))
+            ]
+            return row[0], events
+        finally:
+            connection.close()
+
+    def list_sessions(self):
+        """全部会话的编号、开始时间、帧数和最后一帧的时间"""
+        self.flush()
+        connection = self._connect()
+        try:
+            return connection.execute(
+                'SELECT s.session_id, s.started, COUNT(e.seq), MAX(e.time) '
+                'FROM sessions s LEFT JOIN events e ON e.session_id = s.session_id '
+                'GROUP BY s.session_id ORDER BY s.started'
+            ).fetchall()
+        finally:
+            connection.close()
+
+    def get_stats(self):
+        return {
+            'path': self.path,
+            'error': self.error,
+            'pending': self._queue.qsize(),
+            'written': self.written,
+            'dropped': self.dropped,
+            'commits': self.commits
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description="会话事件日志：列出会话、根据日志重新生成报告")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    list_parser = subparsers.add_parser('list', help="列出日志中的会话")
+    list_parser.add_argument('--db', default='sessions.db', help="事件日志文件")
+    report_parser = subparsers.add_parser('report', help="根据日志重新生成会话的PDF报告")
+    report_parser.add_argument('session_id', help="会话编号")
+    report_parser.add_argument('--db', default='sessions.db', help="事件日志文件")
+    report_parser.add_argument('--report-dir', default='.', help="PDF报告输出目录")
+    args = parser.parse_args()
+
+    log = SessionEventLog(args.db)
+    if args.command == 'list':
+        for session_id, started, frames, last in log.list_sessions():
+            started_text = datetime.datetime.fromtimestamp(started).strftime('%Y-%m-%d %H:%M:%S')
+            duration = f", 时长 {last - started:.0f} 秒" if last is not None else ''
+            print(f"{session_id}: 开始于 {started_text}, {frames} 帧{duration}")
+        return
+
+    import python_server
+
+    loaded = log.load_session(args.session_id)
+    if loaded is None:
+        raise SystemExit(f"未找到会话: {args.session_id}")
+    analyzer = python_server.restore_analyzer(*loaded)
+    analyzer.generate_pdf_report(python_server.FileReportSink(args.report_dir), args.session_id)
+
+if __name__ == "__main__":
+    main()
@@ -4,9 +4,12 @@ import java.io.IOException;
 import java.net.URI;
 import java.net.http.HttpClient;
 import java.net.http.WebSocket;
+import java.nio.ByteBuffer;
 import java.util.Set;
+import java.util.concurrent.CompletableFuture;
 import java.util.concurrent.CompletionStage;
 import java.util.concurrent.ConcurrentHashMap;
+import java.util.function.Function;
 
 import javax.websocket.OnClose;
 import javax.websocket.OnError;
@@ -22,6 +25,12 @@ public class NumberWebSocket {
     private Session session;
     private WebSocket pythonWebSocket;
     private volatile boolean isConnected = false;
+    // Python服务器模型是否已加载完成，完成前不转发图像帧
+    private volatile boolean isPythonReady = false;
+    // 发往Python服务器的消息依次发送：WebSocket同一时间只允许一个未完成的发送
+    private CompletableFuture<WebSocket> lastSend = CompletableFuture.completedFuture(null);
+    // 重新连接Python服务器后，新的Python会话使用默认配置，需要让页面重新发送会话配置
+    private volatile boolean needsRenegotiate = false;
 
     @OnOpen
     public void onOpen(Session session) {
@@ -47,6 +56,15 @@ public class NumberWebSocket {
                         System.out.println("收到Python服务器心跳响应");
                         return WebSocket.Listener.super.onText(webSocket, data, last);
                     }
+                    if (data.toString().startsWith("health:")) {
+                        handleHealth(data.toString());
+                        return WebSocket.Listener.super.onText(webSocket, data, last);
+                    }
+                    // 会话配置的回复(含会话编号)和画质调整建议只属于本连接，不广播给其他客户端
+                    if (isSessionReply(data.toString())) {
+                        sendToOwner(data.toString());
+                        return WebSocket.Listener.super.onText(webSocket, data, last);
+                    }
                     
                     broadcastMessage(data.toString());
                     return WebSocket.Listener.super.onText(webSocket, data, last);
@@ -56,6 +74,12 @@ public class NumberWebSocket {
                 public void onOpen(WebSocket webSocket) {
                     System.out.println("Python WebSocket连接已建立");
                     isConnected = true;
+                    isPythonReady = false;
+                    sendToPython(webSocket, ws -> ws.sendText("health", true));
+                    if (needsRenegotiate) {
+                        needsRenegotiate = false;
+                        sendToOwner("renegotiate");
+                    }
                     WebSocket.Listener.super.onOpen(webSocket);
                 }
 
@@ -63,6 +87,22 @@ public class NumberWebSocket {
                 public CompletionStage<?> onClose(WebSocket webSocket, int statusCode, String reason) {
                     System.out.println("Python WebSocket连接关闭 - 状态码: " + statusCode + ", 原因: " + reason);
                     isConnected = false;
+                    isPythonReady = false;
+                    // 1013：Python服务器过载拒绝了本连接，稍后重试
+                    if (statusCode == 1013 && session.isOpen()) {
+                        needsRenegotiate = true;
+                        new Thread(() -> {
+                            try {
+                                Thread.sleep(5000);
+                                if (session.isOpen()) {
+                                    System.out.println("Python服务器过载，重新尝试连接...");
+                                    connectToPython();
+                                }
+                            } catch (InterruptedException ie) {
+                                Thread.currentThread().interrupt();
+                            }
+                        }).start();
+                    }
                     return WebSocket.Listener.super.onClose(webSocket, statusCode, reason);
                 }
 
@@ -78,6 +118,7 @@ public class NumberWebSocket {
             e.printStackTrace();
             if (!isConnected) {
                 System.out.println("启动重连机制...");
+                needsRenegotiate = true;
                 new Thread(() -> {
                     try {
                         Thread.sleep(5000);
@@ -92,6 +133,54 @@ public class NumberWebSocket {
         }
     }
 
+    // 处理Python服务器的就绪状态：模型加载中时每秒重新查询一次
+    private void handleHealth(String message) {
+        String status = message.substring("health:".length());
+        if ("ready".equals(status)) {
+            System.out.println("Python服务器模型已就绪");
+            isPythonReady = true;
+            return;
+        }
+        System.out.println("Python服务器尚未就绪: " + status);
+        new Thread(() -> {
+            try {
+                Thread.sleep(1000);
+                if (isConnected) {
+                    sendToPython(pythonWebSocket, ws -> ws.sendText("health", true));
+                }
+            } catch (InterruptedException ie) {
+                Thread.currentThread().interrupt();
+            }
+        }).start();
+    }
+
+    // 在上一次发送完成(无论成功与否)后再发送，避免同时有多个发送导致 IllegalStateException
+    private synchronized CompletableFuture<WebSocket> sendToPython(WebSocket webSocket,
+            Function<WebSocket, CompletableFuture<WebSocket>> send) {
+        CompletableFuture<WebSocket> next = lastSend
+            .handle((result, error) -> webSocket)
+            .thenCompose(send);
+        lastSend = next;
+        return next;
+    }
+
+    // 只属于单个会话的回复：会话配置结果、画质调整建议
+    private static boolean isSessionReply(String message) {
+        return message.startsWith("config_ok:") || message.startsWith("config_error:")
+            || message.startsWith("quality:");
+    }
+
+    // 只发送给本Python连接所属的客户端
+    private void sendToOwner(String message) {
+        try {
+            if (session != null && session.isOpen()) {
+                session.getBasicRemote().sendText(message);
+            }
+        } catch (IOException e) {
+            System.err.println("发送消息到会话 " + session.getId() + " 失败: " + e.getMessage());
+        }
+    }
+
     // 广播消息给所有连接的客户端
     private void broadcastMessage(String message) {
         System.out.println("广播消息: " + message);
@@ -147,16 +236,31 @@ public class NumberWebSocket {
                 return;
             }
 
+            if (message.startsWith("config:")) {
+                System.out.println("转发会话配置到Python服务器: " + message);
+                sendToPython(pythonWebSocket, ws -> ws.sendText(message, true))
+                    .exceptionally(throwable -> {
+                        System.err.println("转发会话配置失败: " + throwable.getMessage());
+                        sendToOwner("config_error:转发会话配置失败: " + throwable.getMessage());
+                        return null;
+                    });
+                return;
+            }
+
             if (message.startsWith("data:image")) {
+                if (!isPythonReady) {
+                    sendErrorMessage(session, "Python服务器模型加载中");
+                    return;
+                }
                 System.out.println("准备发送图像数据到Python服务器");
-                pythonWebSocket.sendText(message, true)
+                sendToPython(pythonWebSocket, ws -> ws.sendText(message, true))
                     .exceptionally(throwable -> {
                         System.err.println("发送数据到Python服务器失败: " + throwable.getMessage());
                         throwable.printStackTrace();
                         sendErrorMessage(session, "发送数据失败: " + throwable.getMessage());
                         return null;
                     });
-                System.out.println("图像数据已发送到Python服务器");
+                System.out.println("图像数据已加入发送队列");
             }
         } catch (Exception e) {
             System.err.println("处理消息时发生异常: " + e.getMessage());
@@ -165,6 +269,33 @@ public class NumberWebSocket {
         }
     }
 
+    // 二进制JPEG帧（可带16字节帧头）原样转发给Python服务器
+    @OnMessage(maxMessageSize = 2097152)
+    public void onBinaryMessage(ByteBuffer data, Session session) {
+        System.out.println("收到二进制图像帧: " + data.remaining() + " bytes");
+
+        if (!isConnected) {
+            System.err.println("Python服务器未连接，消息被丢弃");
+            sendErrorMessage(session, "Python服务器未连接");
+            return;
+        }
+        if (!isPythonReady) {
+            sendErrorMessage(session, "Python服务器模型加载中");
+            return;
+        }
+
+        // 发送排队期间容器可能复用原缓冲区，先复制一份
+        ByteBuffer frame = ByteBuffer.allocate(data.remaining());
+        frame.put(data).flip();
+        sendToPython(pythonWebSocket, ws -> ws.sendBinary(frame, true))
+            .exceptionally(throwable -> {
+                System.err.println("发送数据到Python服务器失败: " + throwable.getMessage());
+                throwable.printStackTrace();
+                sendErrorMessage(session, "发送数据失败: " + throwable.getMessage());
+                return null;
+            });
+    }
+
     private void sendErrorMessage(Session session, String message) {
         try {
             session.getBasicRemote().sendText("错误：" + message);
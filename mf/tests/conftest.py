@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 服务端各模块以脚本方式运行，测试时把 mf 目录加入导入路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
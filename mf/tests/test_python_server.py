@@ -0,0 +1,178 @@
+"""
+python_server 中不依赖模型的部分：帧头和JPEG段头解析、情绪时间序列、实时汇总的时间桶、
+人脸编号、令牌桶和会话配置校验
+
+运行: cd mf && python -m pytest tests
+"""
+
+import cv2
+import numpy as np
+import pytest
+
+import python_server as ps
+
+N = len(ps.EMOTION_COLUMNS)
+
+def one_hot(emotion):
+    probs = np.zeros(N)
+    probs[ps.EMOTION_COLUMNS.index(emotion)] = 1.0
+    return probs
+
+def encode_jpeg(width, height):
+    img = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    return cv2.imencode('.jpg', img)[1].tobytes()
+
+# ---- 帧解析 ----
+
+def test_jpeg_size_reads_sof_without_decoding():
+    assert ps.jpeg_size(encode_jpeg(320, 240)) == (320, 240)
+    assert ps.jpeg_size(b'MF' + encode_jpeg(64, 48), offset=2) == (64, 48)
+
+def test_jpeg_size_rejects_non_jpeg_and_truncated_data():
+    data = encode_jpeg(320, 240)
+    assert ps.jpeg_size(b'not a jpeg') is None
+    assert ps.jpeg_size(data[:20]) is None
+    assert ps.jpeg_size(b'\xff\xd8garbage') is None
+
+def test_parse_binary_frame_with_face_box():
+    jpeg = encode_jpeg(64, 48)
+    header = ps.FRAME_HEADER.pack(ps.FRAME_MAGIC, 1, ps.FRAME_FLAG_FACE_BOX, 42, 1.5)
+    box = ps.FRAME_FACE_BOX.pack(1, 2, 30, 40, 0.5)
+    frame_id, timestamp, face_box, offset = ps.parse_binary_frame(header + box + jpeg)
+    assert (frame_id, timestamp) == (42, 1.5)
+    assert face_box == [1.0, 2.0, 30.0, 40.0, 0.5]
+    assert offset == ps.FRAME_HEADER.size + ps.FRAME_FACE_BOX.size
+
+def test_parse_binary_frame_without_header():
+    assert ps.parse_binary_frame(encode_jpeg(64, 48)) == (None, None, None, 0)
+    header = ps.FRAME_HEADER.pack(ps.FRAME_MAGIC, 1, 0, 7, 0.0)
+    assert ps.parse_binary_frame(header + encode_jpeg(64, 48)) == (7, 0.0, None, ps.FRAME_HEADER.size)
+
+# ---- 情绪时间序列 ----
+
+def test_timeline_ring_keeps_latest_frames_in_order():
+    timeline = ps.EmotionTimeline(capacity=4, bucket_seconds=1, max_buckets=16)
+    for t in range(6):
+        timeline.append(one_hot('happiness' if t < 3 else 'sadness'), timestamp=float(t))
+    timestamps, _, labels = timeline._ordered()
+    assert timestamps.tolist() == [2.0, 3.0, 4.0, 5.0]
+    assert len(timeline) == 4 and timeline.total == 6
+    assert labels.tolist() == [ps.EMOTION_COLUMNS.index(e) for e in ('happiness', 'sadness', 'sadness', 'sadness')]
+
+def test_timeline_windowed_queries():
+    timeline = ps.EmotionTimeline(capacity=16, bucket_seconds=1, max_buckets=16)
+    for t, emotion in enumerate(['neutral', 'neutral', 'happiness', 'neutral', 'happiness']):
+        timeline.append(one_hot(emotion), timestamp=float(t))
+    # 整段会话的累计值
+    assert timeline.transition_count() == 3
+    assert timeline.dwell_times()['neutral'] == pytest.approx(3.0)
+    assert timeline.dwell_times()['happiness'] == pytest.approx(1.0)
+    # 最近2秒：t=2,3,4
+    assert timeline.transition_count(seconds=2) == 2
+    assert timeline.dwell_times(seconds=2)['happiness'] == pytest.approx(1.0)
+    mean = timeline.mean(seconds=2)
+    assert mean[ps.EMOTION_COLUMNS.index('happiness')] == pytest.approx(2 / 3)
+    rolling = timeline.rolling_mean(2)
+    assert rolling.shape == (4, N)
+    assert rolling[1][ps.EMOTION_COLUMNS.index('happiness')] == pytest.approx(0.5)
+    assert timeline.rolling_mean(10).shape == (0, N)
+
+def test_timeline_merges_buckets_when_full():
+    timeline = ps.EmotionTimeline(capacity=8, bucket_seconds=1, max_buckets=4)
+    for t in range(8):
+        timeline.append(one_hot('happiness' if t < 4 else 'sadness'), timestamp=float(t))
+    starts, means = timeline.buckets()
+    # 8秒写入4个桶，桶宽加倍为2秒
+    assert timeline.bucket_seconds == 2
+    assert starts.tolist() == [0.0, 2.0, 4.0, 6.0]
+    assert timeline.bucket_counts.sum() == 8
+    assert means[0][ps.EMOTION_COLUMNS.index('happiness')] == pytest.approx(1.0)
+    assert means[3][ps.EMOTION_COLUMNS.index('sadness')] == pytest.approx(1.0)
+
+def test_timeline_summary_before_first_frame():
+    summary = ps.EmotionTimeline(capacity=4).summary(seconds=10, rolling=2, buckets=True)
+    assert summary['frames'] == 0 and summary['transitions'] == 0
+    assert summary['rolling_mean'] == [] and summary['buckets']['start'] == []
+
+def test_parse_timeline_params():
+    assert ps.parse_timeline_params({'window': 30, 'rolling': 5, 'buckets': 'true'}) == \
+        {'seconds': 30.0, 'rolling': 5, 'buckets': True}
+    for params in ({'window': 'inf'}, {'window': 0}, {'rolling': 0}, {'rolling': True}, {'other': 1}):
+        with pytest.raises(ValueError):
+            ps.parse_timeline_params(params)
+
+# ---- 实时汇总 ----
+
+def test_bucket_ring_window_and_slot_reuse():
+    ring = ps.BucketRing(1, 4)
+    for t in range(6):
+        ring.add(100.0 + t, t % N, one_hot(ps.EMOTION_COLUMNS[t % N]))
+    counts, prob_sums = ring.totals(3, now=105.5)
+    # 最近3秒：103、104、105
+    assert counts.sum() == 3
+    assert prob_sums.sum() == pytest.approx(3.0)
+    # 环形数组只有4个桶，更早的桶已被覆盖
+    assert ring.totals(10, now=105.5)[0].sum() == 4
+    assert [point['t'] for point in ring.series(2, now=105.5)] == [104, 105]
+
+def test_bucket_ring_ignores_stale_buckets():
+    ring = ps.BucketRing(1, 4)
+    ring.add(100.0, 0, one_hot(ps.EMOTION_COLUMNS[0]))
+    assert ring.totals(4, now=110.0)[0].sum() == 0
+
+def test_parse_analytics_params_rejects_non_finite_window():
+    assert ps.parse_analytics_params({'window': '30', 'series': '1'}) == {'window': 30.0, 'series': True}
+    for window in ('inf', 'nan', 'x'):
+        with pytest.raises(ValueError):
+            ps.parse_analytics_params({'window': window})
+
+# ---- 人脸编号 ----
+
+def test_face_identities_follow_moving_faces():
+    identities = ps.FaceIdentities(min_iou=0.3, max_missed=2)
+    assert identities.assign([[0, 0, 10, 10], [100, 100, 110, 110]]) == [1, 2]
+    # 顺序交换、位置略有移动时编号不变
+    assert identities.assign([[101, 101, 111, 111], [1, 0, 11, 10]]) == [2, 1]
+
+def test_face_identities_age_out_missing_people():
+    identities = ps.FaceIdentities(min_iou=0.3, max_missed=2)
+    assert identities.assign([[0, 0, 10, 10]]) == [1]
+    for _ in range(3):
+        identities.assign([])
+    # 缺席超过 max_missed 帧后同一位置的人脸分配新编号
+    assert identities.assign([[0, 0, 10, 10]]) == [2]
+
+# ---- 令牌桶 ----
+
+def test_token_bucket_limits_rate_after_burst():
+    bucket = ps.TokenBucket(burst=2)
+    bucket.last = 0.0
+    assert bucket.take(1.0, now=0.0) and bucket.take(1.0, now=0.0)
+    assert not bucket.take(1.0, now=0.5)
+    assert bucket.take(1.0, now=1.0)
+    # 速率为0表示不限速
+    assert all(bucket.take(0, now=1.0) for _ in range(5))
+
+# ---- 会话配置 ----
+
+@pytest.fixture
+def session():
+    return ps.ClientSession(websocket=None)
+
+def test_apply_config_accepts_valid_values(session):
+    assert session.apply_config({'au_interval': 3, 'keyframe_interval': 5, 'unknown': 1}) == ['unknown']
+    assert session.config['au_interval'] == 3 and session.config['keyframe_interval'] == 5
+
+@pytest.mark.parametrize('updates', [
+    {'au_interval': 0},
+    {'au_interval': '2'},
+    {'keyframe_interval': True},
+    {'keyframe_interval': 2.5},
+    {'protocol': 'xml'},
+    {'outputs': ['emotion', 'unknown']},
+])
+def test_apply_config_rejects_invalid_values(session, updates):
+    before = dict(session.config)
+    with pytest.raises(ValueError):
+        session.apply_config(updates)
+    assert session.config == before